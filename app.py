@@ -4,12 +4,12 @@ import argparse
 import sys
 import os.path
 sys.path.append(os.path.realpath("./slb"))
-import process
-import util
-import md, tex
+# Subcommands import what they use, so that a client or a small batch doesn't
+# wait for the daemon's modules or the caches to load.
 import nlp
-import socket
-import slbserver
+
+# Seconds a spawned daemon gets to start listening.
+DAEMON_START_TIMEOUT = 10.0
 
 
 def main():
@@ -22,9 +22,10 @@ def main():
     common = argparse.ArgumentParser(add_help=False)
     common.set_defaults(infer_file_format=True)
     common.add_argument("-w",
-                        help="Desired length of lines.",
-                        type=int,
-                        default=80)
+                        help="Desired length of lines. batch with -o also takes a "
+                        "comma separated list, writing each width under DIR/WIDTH/.",
+                        type=parse_widths,
+                        default=[80])
     common.add_argument("-i",
                         help="Input path. Default or \"-\" is stdin.",
                         default="/dev/stdin")
@@ -34,45 +35,357 @@ def main():
                          help="Don't infer the format of the input file",
                          dest="infer_file_format",
                          action="store_false")
+    common.add_argument("--nlp",
+                        help="Tokenizer and break tagger to use, from the fastest "
+                        "regex tier to the full spacy model.",
+                        choices=sorted(nlp.NLP_BACKENDS),
+                        default="regex")
+    common.add_argument("--allocator",
+                        help="Line breaking algorithm.",
+                        choices=sorted(nlp.LINE_BREAKERS),
+                        default="greedy")
+    common.add_argument("--batch-size",
+                        help="Number of paragraphs parsed per model batch.",
+                        type=int,
+                        default=64)
+
+    files = argparse.ArgumentParser(add_help=False)
+    files.add_argument("inputs",
+                       help="Files, directories or globs to format. "
+                       "Defaults to the -i path.",
+                       nargs="*")
+    files.add_argument("--files-from",
+                       help="Read input paths from this file, one per line.")
+    files.add_argument("--in-place",
+                       help="Rewrite input files with the formatted output.",
+                       action="store_true")
+    files.add_argument("-o", "--output-dir",
+                       help="Write formatted files under this directory.")
+
+    daemon = argparse.ArgumentParser(add_help=False)
+    daemon.add_argument("--host",
+                        help="Host of the daemon",
+                        default="localhost")
+    daemon.add_argument("--port",
+                        help="Port of the daemon (default: its usual port)",
+                        type=int)
+    daemon.add_argument("--socket",
+                        help="Unix socket tried before TCP, empty for none "
+                             "(default: derived from the port)")
+    daemon.add_argument("--auto-daemon",
+                        help="Format through the daemon, starting one in the background "
+                        "when none is listening.",
+                        action="store_true")
+    daemon.add_argument("--exit-after-idle",
+                        help="Seconds a daemon started by --auto-daemon waits for "
+                        "another client before exiting.",
+                        metavar="SECONDS",
+                        type=float,
+                        default=600.0)
 
-    batch = subparsers.add_parser("batch", parents=[common])
-    batch.set_defaults(func=batch_process)
+    batch_parser = subparsers.add_parser("batch", parents=[common, files, daemon])
+    batch_parser.add_argument("-j", "--jobs",
+                              help="Number of worker processes. Default is one per CPU.",
+                              type=int)
+    batch_parser.add_argument("--cache-dir",
+                              help="Keep formatted paragraphs in a cache in this directory, "
+                              "so unchanged paragraphs are not formatted again on the next "
+                              "run. Without it nothing is cached on disk.")
+    batch_parser.add_argument("--cache-size",
+                              help="Paragraph cache budget in MiB (default: 64).",
+                              type=int)
+    batch_parser.add_argument("--no-cache",
+                              help="Don't read or write the formatted paragraph cache, "
+                              "even with --cache-dir.",
+                              dest="use_cache",
+                              action="store_false")
+    batch_parser.add_argument("--parse-cache",
+                              help="Also keep paragraph parses in --cache-dir, so other "
+                              "widths and line breakers skip the NLP model.",
+                              action="store_true")
+    batch_parser.add_argument("--stream",
+                              help="Format and write one region at a time as the "
+                              "input is read.",
+                              action="store_true")
+    batch_parser.add_argument("--profile",
+                              help="Print time spent per stage and counters to stderr.",
+                              action="store_true")
+    batch_parser.add_argument("--changed",
+                              help="Only format regions git reports as changed against "
+                              "this revision, or against the index when none is given. "
+                              "Inputs limit the paths looked at.",
+                              metavar="REV",
+                              nargs="?",
+                              const="")
+    batch_parser.set_defaults(func=batch_process)
+
+    check = subparsers.add_parser("check", parents=[common],
+                                  help="Exit non-zero if any input isn't formatted.")
+    check.add_argument("inputs",
+                       help="Files, directories or globs to check.",
+                       nargs="*")
+    check.add_argument("--files-from",
+                       help="Read input paths from this file, one per line.")
+    check.add_argument("-j", "--jobs",
+                       help="Number of worker processes. Default is one per CPU.",
+                       type=int)
+    check.add_argument("--all",
+                       help="Report every differing region instead of stopping "
+                       "at the first difference of a file.",
+                       dest="check_all",
+                       action="store_true")
+    check.set_defaults(func=check_process)
 
     start = subparsers.add_parser("start", parents=[common])
+    start.add_argument("--host",
+                       help="Address to listen on",
+                       default="localhost")
+    start.add_argument("--port",
+                       help="Port to listen on (default: the usual daemon port)",
+                       type=int)
+    start.add_argument("--workers",
+                       help="Number of documents formatted at once",
+                       type=int,
+                       default=4)
+    start.add_argument("--max-pending",
+                       help="Requests accepted before clients are pushed back",
+                       type=int,
+                       default=64)
+    start.add_argument("--idle-timeout",
+                       help="Seconds an idle client connection is kept open",
+                       type=float,
+                       default=300.0)
+    start.add_argument("--warm-up",
+                       help="Load the NLP model before accepting connections",
+                       action="store_true")
+    start.add_argument("--socket",
+                       help="Unix socket to listen on as well, empty for none "
+                            "(default: derived from the port)")
+    start.add_argument("--processes",
+                       help="Worker processes sharing the loaded model, SIGHUP reloads it",
+                       type=int,
+                       default=1)
+    start.add_argument("--exit-after-idle",
+                       help="Exit after this many seconds without a client connection, "
+                       "unless --processes forks workers",
+                       metavar="SECONDS",
+                       type=float)
     start.set_defaults(func=start_server)
 
-    client = subparsers.add_parser("client", parents=[common])
-    client.add_argument("--host",
-                        help="Host to connect to",
-                        default="localhost")
-    client.add_argument("--port",
-                        help="Port to connect to",
-                        default=slbserver.PORT)
+    lsp_parser = subparsers.add_parser("lsp", parents=[common],
+                                       help="Serve formatting to editors over the "
+                                       "Language Server Protocol on stdio.")
+    lsp_parser.set_defaults(func=lsp_process)
+
+    client = subparsers.add_parser("client", parents=[common, files, daemon])
+    client.add_argument("--stats",
+                        help="Print the daemon's cumulative statistics as JSON.",
+                        action="store_true")
     client.set_defaults(func=client_process)
 
     args = parser.parse_args()
+    if hasattr(args, "w"):
+        args.widths = args.w
+        args.w = args.widths[0]
+        if len(args.widths) > 1 and args.func is not batch_process:
+            args.parser.error("only batch takes several widths")
+    if getattr(args, "port", 0) is None:
+        import protocol
+        args.port = protocol.PORT
     args.func(args)
 
 
+def parse_widths(value):
+    try:
+        widths = [int(w) for w in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a width or a comma separated list of them")
+    return list(dict.fromkeys(widths))
+
+
 def print_help(args):
     args.parser.print_help()
 
 
 def batch_process(args):
+    if args.auto_daemon:
+        if args.changed is not None or args.stream or args.profile or len(args.widths) > 1:
+            args.parser.error("--auto-daemon doesn't take --changed, --stream, --profile "
+                              "or several widths")
+        format_with_daemon(args)
+        return
+    if args.parse_cache and args.cache_dir is None:
+        args.parser.error("--parse-cache needs --cache-dir")
+    import batch
+    import cache
+    import instrument
+    instrument.enable(args.profile)
+    # The caches are only written where the user asks for them.
+    args.use_cache = args.use_cache and args.cache_dir is not None
+    cache_bytes = cache.DEFAULT_MAX_BYTES
+    if args.cache_size is not None:
+        cache_bytes = args.cache_size * 1024 * 1024
     format_kwargs = get_format_args(args)
+    if args.use_cache:
+        format_kwargs["cache"] = cache.ParagraphCache(args.cache_dir, cache_bytes)
+    if args.parse_cache:
+        format_kwargs["parse_cache"] = cache.ParseCache(cache_dir=args.cache_dir,
+                                                        max_bytes=cache_bytes)
+    if len(args.widths) > 1:
+        # Every width is formatted from one parse, see Doc.format_widths.
+        if args.output_dir is None or args.in_place or args.stream or args.changed is not None:
+            args.parser.error("several widths need -o and no --in-place, --stream or --changed")
+        format_kwargs["fill_widths"] = args.widths
+    if args.changed is not None:
+        jobs = get_changed_jobs(args)
+    else:
+        inputs = get_inputs(args)
+        if not inputs:
+            format_stdin(args, format_kwargs)
+            return
+        jobs = [(path, resolve_doc_type(args, path), out_path)
+                for path, out_path in get_file_jobs(args, inputs)]
+
+    throughput = batch.Throughput()
+    profile = instrument.Stats()
+    for result in batch.run(jobs, format_kwargs, args.jobs, args.stream, args.profile):
+        throughput.add(result)
+        if "profile" in result:
+            profile.merge(result["profile"])
+        if "error" in result:
+            print("{}: {}".format(result["path"], result["error"]), file=sys.stderr)
+        elif "output" in result:
+            sys.stdout.write(result["output"])
+    throughput.report()
+    if args.profile:
+        profile.report()
+    if throughput.errors:
+        sys.exit(1)
+
+
+def format_stdin(args, format_kwargs):
+    import batch
+    import instrument
+    import util
     doc_class = resolve_doc_type(args)
     with open(args.i, mode="r", encoding="utf-8") as inputFile:
         source = util.FileTextSource(inputFile)
-        doc = doc_class.from_source(source)
-        print("\n".join(doc.format_out(**format_kwargs)))
+        if args.stream:
+            batch.write_regions(doc_class.format_regions(source, **format_kwargs),
+                                sys.stdout)
+        else:
+            doc = doc_class.from_source(source)
+            print("\n".join(doc.format_out(**format_kwargs)))
+    if args.use_cache:
+        format_kwargs["cache"].close()
+    if args.parse_cache:
+        format_kwargs["parse_cache"].close()
+    if args.profile:
+        instrument.STATS.report()
+
+
+def get_changed_jobs(args):
+    import batch
+    import gitdiff
+    import subprocess
+    try:
+        changed = gitdiff.changed_hunks(args.changed or None, args.inputs)
+    except (OSError, subprocess.CalledProcessError) as e:
+        args.parser.error("git diff failed: {}".format(
+            (getattr(e, "stderr", None) or str(e)).strip()))
+    paths = [path for path in sorted(changed) if path.endswith(batch.EXTENSIONS)]
+    return [(path, resolve_doc_type(args, path), out_path, changed[path])
+            for path, out_path in get_file_jobs(args, paths)]
+
+
+def check_process(args):
+    import batch
+    inputs = list(args.inputs)
+    if args.files_from is not None:
+        inputs.extend(batch.read_file_list(args.files_from))
+    if not inputs:
+        args.parser.error("check needs input paths")
+    jobs = [(path, resolve_doc_type(args, path), None)
+            for path, rel_path in batch.expand_inputs(inputs)]
+
+    throughput = batch.Throughput()
+    unformatted = 0
+    for result in batch.run(jobs, get_format_args(args), args.jobs, check=args.check_all):
+        throughput.add(result)
+        if "error" in result:
+            print("{}: {}".format(result["path"], result["error"]), file=sys.stderr)
+        elif result["differences"]:
+            unformatted += 1
+            for line in result["differences"]:
+                print("{}:{}: not formatted".format(result["path"], line))
+    throughput.report()
+    print("{} of {} files not formatted".format(unformatted, len(jobs)), file=sys.stderr)
+    if unformatted or throughput.errors:
+        sys.exit(1)
 
 
 def start_server(args):
-    server = slbserver.SlbDaemon()
+    import cache
+    import slbserver
+    if args.processes > 1 and not hasattr(os, "fork"):
+        sys.exit("--processes needs a platform with fork")
+    server = slbserver.SlbDaemon(host=args.host,
+                                 port=args.port,
+                                 workers=args.workers,
+                                 max_pending=args.max_pending,
+                                 idle_timeout=args.idle_timeout,
+                                 warm_up=args.warm_up,
+                                 processes=args.processes,
+                                 socket_path=get_socket_path(args),
+                                 exit_after_idle=args.exit_after_idle,
+                                 format_kwargs=get_format_args(args))
+    # Editors reflow at whatever width their panes have, parses are kept
+    # across requests so a resize only allocates lines again.
+    server.format_kwargs["parse_cache"] = cache.ParseCache()
     server.run()
 
 
-def resolve_doc_type(args) -> process.Doc:
+def lsp_process(args):
+    import cache
+    import lsp
+    format_kwargs = get_format_args(args)
+    format_kwargs["parse_cache"] = cache.ParseCache()
+    sys.exit(lsp.LspServer(format_kwargs).run())
+
+
+def get_inputs(args):
+    inputs = list(args.inputs)
+    if args.files_from is not None:
+        import batch
+        inputs.extend(batch.read_file_list(args.files_from))
+    if not inputs and (args.in_place or args.output_dir is not None):
+        args.parser.error("--in-place and -o need input paths")
+    return inputs
+
+
+def get_file_jobs(args, inputs):
+    import batch
+    for path, rel_path in batch.expand_inputs(inputs):
+        if args.in_place:
+            out_path = path
+        elif args.output_dir is not None and len(args.widths) > 1:
+            out_path = {width: os.path.join(args.output_dir, str(width), rel_path)
+                        for width in args.widths}
+        elif args.output_dir is not None:
+            out_path = os.path.join(args.output_dir, rel_path)
+        else:
+            out_path = None
+        yield path, out_path
+
+
+def resolve_doc_type(args, path=None):
+    import md, tex
+    format_to_class = {"md": md.MdDoc,
+                       "tex": tex.TexDoc}
+    return format_to_class[resolve_format(args, path)]
+
+
+def resolve_format(args, path=None) -> str:
     DEFAULT_FORMAT = "md"
     format_str = None
     if args.f is not None:
@@ -81,7 +394,7 @@ def resolve_doc_type(args) -> process.Doc:
     extension_to_format = {"md": "md",
                            "tex": "tex"}
         
-    file_tail = args.i[-4:]
+    file_tail = (path if path is not None else args.i)[-4:]
     if format_str is None and args.infer_file_format \
        and "." in file_tail:
         extension = file_tail.split(".")[1]
@@ -90,26 +403,154 @@ def resolve_doc_type(args) -> process.Doc:
 
     if format_str is None:
         format_str = DEFAULT_FORMAT
-
-    format_to_class = {"md": md.MdDoc,
-                       "tex": tex.TexDoc}
-    return format_to_class[format_str]
+    return format_str
 
 
 def client_process(args):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.connect((args.host, args.port))
+    if args.stats:
+        import protocol
+        with connect(args) as sock:
+            sock.sendall(protocol.make_frame(protocol.KIND_STATS, 0, None, b""))
+            response = protocol.read_frame(sock)
+        print(response["body"])
+        return
+    format_with_daemon(args)
+
+
+def format_with_daemon(args):
+    import protocol
+    inputs = get_inputs(args)
+    if inputs:
+        client_pipeline(args, inputs)
+        return
+    with connect(args) as sock:
         with open(args.i, mode="rb") as inputFile:
             file_bytes = inputFile.read()
-        header = slbserver.make_request_header(len(file_bytes))
-        sock.sendall(header)
-        sock.sendall(file_bytes)
-        response = slbserver.read_response(sock)
-        print(response[1])
+        sock.sendall(protocol.make_frame(protocol.KIND_FORMAT, 0, get_request_options(args),
+                                         file_bytes))
+        response = protocol.read_frame(sock)
+    if response["kind"] == protocol.KIND_ERROR:
+        sys.exit(response["body"])
+    print(response["body"])
+
+
+def client_pipeline(args, inputs):
+    import batch
+    import protocol
+    import socket
+    import threading
+    jobs = [(path, resolve_format(args, path), out_path)
+            for path, out_path in get_file_jobs(args, inputs)]
+    sizes = [None] * len(jobs)
+    outputs = dict()
+    throughput = batch.Throughput()
+    with connect(args) as sock:
+        # Large bodies go through shared memory when the daemon is local.
+        use_shm = sock.family == getattr(socket, "AF_UNIX", None)
+
+        def send_requests():
+            for request_id, (path, format_str, out_path) in enumerate(jobs):
+                with open(path, mode="rb") as inputFile:
+                    file_bytes = inputFile.read()
+                sizes[request_id] = (file_bytes.count(b"\n"), len(file_bytes))
+                options = get_request_options(args, path)
+                if use_shm and len(file_bytes) >= protocol.SHM_MIN_BYTES:
+                    options["shm"] = protocol.write_shm(file_bytes)
+                    file_bytes = b""
+                sock.sendall(protocol.make_frame(protocol.KIND_FORMAT, request_id,
+                                                 options, file_bytes))
+
+        sender = threading.Thread(target=send_requests, daemon=True)
+        sender.start()
+        for i in range(len(jobs)):
+            response = protocol.read_frame(sock)
+            request_id = response["request_id"]
+            path, format_str, out_path = jobs[request_id]
+            lines, size = sizes[request_id]
+            if response["kind"] == protocol.KIND_ERROR:
+                throughput.add({"path": path, "error": response["body"]})
+                print("{}: {}".format(path, response["body"]), file=sys.stderr)
+                continue
+            throughput.add({"path": path, "lines": lines, "bytes": size})
+            output = response["body"] + "\n"
+            if out_path is None:
+                outputs[request_id] = output
+                continue
+            out_dir = os.path.dirname(out_path)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            with open(out_path, mode="w", encoding="utf-8") as outputFile:
+                outputFile.write(output)
+        sender.join()
+    for request_id in sorted(outputs):
+        sys.stdout.write(outputs[request_id])
+    throughput.report()
+    if throughput.errors:
+        sys.exit(1)
+
+
+def get_request_options(args, path=None):
+    return {"format": resolve_format(args, path), "fill_width": args.w,
+            "nlp": args.nlp, "allocator": args.allocator}
+
+
+def get_socket_path(args):
+    if args.socket is None:
+        import protocol
+        return protocol.default_socket_path(args.port)
+    return args.socket
+
+
+def connect(args):
+    import protocol
+    try:
+        return protocol.connect(args.host, args.port, get_socket_path(args))
+    except OSError:
+        if not args.auto_daemon:
+            raise
+    return spawn_daemon(args)
+
+
+def spawn_daemon(args):
+    # Starts a daemon in its own session, which outlives this process and
+    # exits after --exit-after-idle seconds without clients, and connects
+    # once it listens. When another client spawns one at the same time, the
+    # daemon that loses the port exits and the other is used.
+    import protocol
+    import subprocess
+    import time
+    command = [sys.executable, os.path.abspath(sys.argv[0]), "start",
+               "--host", args.host,
+               "--port", str(args.port),
+               "--nlp", args.nlp,
+               "--allocator", args.allocator,
+               "--batch-size", str(args.batch_size),
+               "--exit-after-idle", str(args.exit_after_idle)]
+    if args.socket is not None:
+        command += ["--socket", args.socket]
+    daemon = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while True:
+        exited = daemon.poll() is not None
+        try:
+            return protocol.connect(args.host, args.port, get_socket_path(args))
+        except OSError:
+            if exited:
+                sys.exit("the daemon exited with status {}".format(daemon.returncode))
+            if time.monotonic() > deadline:
+                sys.exit("the daemon didn't start listening in {:.0f}s"
+                         .format(DAEMON_START_TIMEOUT))
+        time.sleep(0.05)
 
 
 def get_format_args(args):
-    return {"fill_width": args.w}
+    tokenizer, allocator = nlp.NLP_BACKENDS[args.nlp]
+    allocator = nlp.LINE_BREAKERS[args.allocator][allocator]
+    return {"fill_width": args.w,
+            "tokenizer": tokenizer,
+            "allocator": allocator,
+            "batch_size": args.batch_size}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+import argparse
+import os.path
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "slb"))
+import nlp
+
+
+SEED_DOC = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        "..", "test_docs", "post.md")
+
+
+def make_paragraph(n_tokens, seed=0):
+    with open(SEED_DOC, mode="r", encoding="utf-8") as seedFile:
+        words = seedFile.read().split()
+    rng = random.Random(seed)
+    return [rng.choice(words) for _ in range(n_tokens)]
+
+
+def time_allocator(allocator, tokens, fill_width, repeat):
+    best = None
+    lines = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines = allocator.allocate(tokens, nlp.Tokenizer.token_len_with_whitespace,
+                                   fill_width=fill_width)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the greedy allocator "
+                                     "with its NumPy backend.")
+    parser.add_argument("--sizes",
+                        help="Comma separated paragraph sizes in tokens.",
+                        default="100,1000,10000,50000")
+    parser.add_argument("-w",
+                        help="Desired length of lines.",
+                        type=int,
+                        default=80)
+    parser.add_argument("--repeat",
+                        help="Runs per measurement, the best is reported.",
+                        type=int,
+                        default=5)
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12} {:>8}".format("tokens", "greedy ms", "numpy ms", "speedup"))
+    for size in (int(s) for s in args.sizes.split(",")):
+        tokens = make_paragraph(size)
+        greedy, greedy_lines = time_allocator(nlp.Allocator, tokens, args.w, args.repeat)
+        vector, vector_lines = time_allocator(nlp.NumpyAllocator, tokens, args.w, args.repeat)
+        if greedy_lines != vector_lines:
+            sys.exit("allocators disagree on a {} token paragraph".format(size))
+        print("{:>8} {:>12.2f} {:>12.2f} {:>7.1f}x".format(size, greedy * 1000,
+                                                          vector * 1000, greedy / vector))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#! /usr/bin/env python
+
+import argparse
+import datetime
+import glob
+import json
+import os.path
+import platform
+import random
+import sys
+import time
+import tracemalloc
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "slb"))
+import md
+import nlp
+import tex
+import util
+
+from process import Paragraph
+
+
+TEST_DOCS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "test_docs")
+DOC_FORMATS = {"md": md.MdDoc,
+               "tex": tex.TexDoc}
+STAGES = ["regions", "join_read_lines", "tokenize", "tag_breaks", "allocate", "join_tokens"]
+
+
+def read_seed_docs():
+    docs = []
+    for path in sorted(glob.glob(os.path.join(TEST_DOCS, "*.md"))):
+        with open(path, mode="r", encoding="utf-8") as seedFile:
+            docs.append(seedFile.read().split("\n"))
+    return docs
+
+
+def shuffle_line(line, rng):
+    # Keeps the indentation and first word, which carry the markup.
+    stripped = line.lstrip(" ")
+    words = stripped.split(" ")
+    if len(words) < 4:
+        return line
+    rest = words[1:]
+    rng.shuffle(rest)
+    return " " * (len(line) - len(stripped)) + " ".join([words[0]] + rest)
+
+
+def make_md_corpus(scale, rng):
+    lines = []
+    for _ in range(scale):
+        for doc in read_seed_docs():
+            lines.extend(shuffle_line(line, rng) for line in doc)
+            lines.append("")
+    return "\n".join(lines)
+
+
+def make_tex_corpus(scale, rng):
+    # Prose from the seed docs, every fourth block as an itemize environment.
+    sentences = []
+    for doc in read_seed_docs():
+        for line in doc:
+            if line and line[0].isalpha():
+                sentences.extend(s.strip() + "." for s in line.split(".") if s.strip())
+    lines = []
+    for block in range(scale * 40):
+        chosen = [shuffle_line(rng.choice(sentences), rng) for _ in range(rng.randint(2, 6))]
+        if block % 4 == 3:
+            lines.append("\\begin{itemize}")
+            for sentence in chosen:
+                words = sentence.split(" ")
+                half = len(words) // 2 or 1
+                lines.append("\\item[-] " + " ".join(words[:half]))
+                if words[half:]:
+                    lines.append("  " + " ".join(words[half:]))
+            lines.append("\\end{itemize}")
+        else:
+            lines.extend(chosen)
+        lines.append("")
+    return "\n".join(lines)
+
+
+CORPORA = {"md": make_md_corpus,
+           "tex": make_tex_corpus}
+
+
+def pretagged(allocator):
+    # Returns the tags computed in the tag_breaks stage, so that allocate is
+    # timed without tagging.
+    class Pretagged(allocator):
+        current = None
+
+        @classmethod
+        def tag_desired_breaks(cls, doc, **kwargs):
+            return cls.current[0]
+
+        @classmethod
+        def tag_illegal_breaks(cls, doc, **kwargs):
+            return cls.current[1]
+    return Pretagged
+
+
+def run_stages(data, doc_class, kwargs):
+    timings = dict()
+
+    start = time.perf_counter()
+    doc = doc_class.from_source(util.MappedTextSource(data))
+    timings["regions"] = time.perf_counter() - start
+
+    kwargs = doc.get_format_config(**kwargs)
+    can_flow = kwargs.get("can_flow", lambda p: True)
+    paragraphs = list(doc.get_paragraphs())
+    start = time.perf_counter()
+    texts = [Paragraph.join_read_lines(p.lines) for p in paragraphs]
+    timings["join_read_lines"] = time.perf_counter() - start
+    texts = [text for text, p in zip(texts, paragraphs) if can_flow(p)]
+
+    tokenizer = kwargs["tokenizer"]
+    allocator = kwargs["allocator"]
+    start = time.perf_counter()
+    docs = tokenizer.tokenize_all(texts, **kwargs)
+    timings["tokenize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tags = [(allocator.tag_desired_breaks(d, **kwargs), allocator.tag_illegal_breaks(d, **kwargs))
+            for d in docs]
+    timings["tag_breaks"] = time.perf_counter() - start
+
+    tagged = pretagged(allocator)
+    start = time.perf_counter()
+    allocated = []
+    for d, tag in zip(docs, tags):
+        tagged.current = tag
+        table = tokenizer.token_table(d, allocator.array_columns(len(d)))
+        allocated.append((table, tagged.allocate_bounds(d, table.lens, table.widths, **kwargs)))
+    timings["allocate"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for table, bounds in allocated:
+        table.lines(bounds)
+    timings["join_tokens"] = time.perf_counter() - start
+
+    counts = {"paragraphs": len(texts), "tokens": sum(len(d) for d in docs)}
+    return timings, counts
+
+
+def time_format(data, doc_class, kwargs):
+    start = time.perf_counter()
+    doc = doc_class.from_source(util.MappedTextSource(data))
+    "\n".join(doc.format_out(**kwargs))
+    return time.perf_counter() - start
+
+
+def peak_memory(data, doc_class, kwargs):
+    tracemalloc.start()
+    try:
+        doc = doc_class.from_source(util.MappedTextSource(data))
+        "\n".join(doc.format_out(**kwargs))
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(fmt, scale, nlp_name, allocator_name, args):
+    data = CORPORA[fmt](scale, random.Random(args.seed)).encode("utf-8")
+    tokenizer, allocator = nlp.NLP_BACKENDS[nlp_name]
+    kwargs = {"fill_width": args.w,
+              "tokenizer": tokenizer,
+              "allocator": nlp.LINE_BREAKERS[allocator_name][allocator],
+              "batch_size": args.batch_size}
+    result = {"format": fmt, "scale": scale, "nlp": nlp_name, "allocator": allocator_name,
+              "lines": data.count(b"\n") + 1, "bytes": len(data)}
+    try:
+        tokenizer.warm_up()
+    except (ImportError, OSError) as e:
+        result["skipped"] = "{}: {}".format(type(e).__name__, e)
+        return result
+
+    doc_class = DOC_FORMATS[fmt]
+    best = None
+    for _ in range(args.repeat):
+        timings, counts = run_stages(data, doc_class, dict(kwargs))
+        if best is None:
+            best = timings
+        else:
+            best = {stage: min(best[stage], timings[stage]) for stage in STAGES}
+    result.update(counts)
+    result["stages"] = best
+    result["total"] = sum(best.values())
+    result["format_seconds"] = min(time_format(data, doc_class, dict(kwargs))
+                                   for _ in range(args.repeat))
+    result["lines_per_sec"] = result["lines"] / max(result["format_seconds"], 1e-9)
+    result["peak_bytes"] = peak_memory(data, doc_class, dict(kwargs))
+    return result
+
+
+def run_key(run):
+    return (run["format"], run["scale"], run["nlp"], run["allocator"])
+
+
+def print_runs(runs, baseline=None):
+    base = {run_key(run): run for run in (baseline or []) if "skipped" not in run}
+    print("{:>4} {:>6} {:>10} {:>9} {:>8} ".format("fmt", "scale", "nlp", "allocator", "lines")
+          + " ".join("{:>15}".format(stage) for stage in STAGES)
+          + " {:>10} {:>10} {:>9}".format("format s", "lines/s", "peak MiB"))
+    for run in runs:
+        row = "{:>4} {:>6} {:>10} {:>9} {:>8} ".format(run["format"], run["scale"], run["nlp"],
+                                                      run["allocator"], run["lines"])
+        if "skipped" in run:
+            print(row + "skipped, " + run["skipped"])
+            continue
+        old = base.get(run_key(run))
+        cells = []
+        for stage in STAGES:
+            cell = "{:.4f}".format(run["stages"][stage])
+            if old is not None and old["stages"][stage] > 0:
+                cell += " {:+.0%}".format(run["stages"][stage] / old["stages"][stage] - 1)
+            cells.append("{:>15}".format(cell))
+        print(row + " ".join(cells) + " {:>10.3f} {:>10.0f} {:>9.1f}".format(
+            run["format_seconds"], run["lines_per_sec"], run["peak_bytes"] / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each formatting stage over "
+                                     "synthetic corpora built from test_docs.")
+    parser.add_argument("--formats",
+                        help="Comma separated corpus formats.",
+                        default="md,tex")
+    parser.add_argument("--scales",
+                        help="Comma separated corpus sizes, in copies of the seed docs.",
+                        default="1,10,100")
+    parser.add_argument("--nlp",
+                        help="Comma separated NLP backends.",
+                        default="regex,spacy")
+    parser.add_argument("--allocators",
+                        help="Comma separated line breakers.",
+                        default="greedy")
+    parser.add_argument("-w",
+                        help="Desired length of lines.",
+                        type=int,
+                        default=80)
+    parser.add_argument("--batch-size",
+                        help="Number of paragraphs parsed per model batch.",
+                        type=int,
+                        default=64)
+    parser.add_argument("--repeat",
+                        help="Runs per measurement, the best is reported.",
+                        type=int,
+                        default=3)
+    parser.add_argument("--seed",
+                        help="Seed of the corpus generator.",
+                        type=int,
+                        default=0)
+    parser.add_argument("-o", "--output",
+                        help="Write the results as JSON to this file.")
+    parser.add_argument("--compare",
+                        help="JSON results of an earlier run to compare stage times with.")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, mode="r", encoding="utf-8") as baselineFile:
+            baseline = json.load(baselineFile)["runs"]
+
+    runs = []
+    for fmt in args.formats.split(","):
+        for nlp_name in args.nlp.split(","):
+            for allocator_name in args.allocators.split(","):
+                for scale in (int(s) for s in args.scales.split(",")):
+                    runs.append(benchmark(fmt, scale, nlp_name, allocator_name, args))
+    print_runs(runs, baseline)
+
+    if args.output is not None:
+        results = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "settings": {"fill_width": args.w, "batch_size": args.batch_size,
+                                "repeat": args.repeat, "seed": args.seed},
+                   "runs": runs}
+        with open(args.output, mode="w", encoding="utf-8") as outputFile:
+            json.dump(results, outputFile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
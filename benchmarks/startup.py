@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+SAMPLE = ("A short paragraph that is long enough to need a break somewhere before "
+          "the end of its only line.\n\n- a list item\n- another item\n")
+
+# Milliseconds each subcommand may spend importing modules, beyond the
+# interpreter's own startup imports.
+BUDGETS = {"batch": 70.0,
+           "check": 50.0,
+           "client": 55.0,
+           "lsp": 65.0}
+
+
+def top_level_seconds(log):
+    total = 0
+    for line in log.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        # Nested imports are indented by two more spaces per level.
+        if fields[2][1:2] != " ":
+            total += int(fields[1])
+    return total / 1e6
+
+
+def lsp_session():
+    # Initializes and shuts down, so that the server exits cleanly.
+    messages = [{"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {}},
+                {"jsonrpc": "2.0", "id": 2, "method": "shutdown"},
+                {"jsonrpc": "2.0", "method": "exit"}]
+    bodies = [json.dumps(message).encode("utf-8") for message in messages]
+    return b"".join(b"Content-Length: %d\r\n\r\n" % len(body) + body for body in bodies)
+
+
+def measure(command, stdin, repeat):
+    # Best import and wall time of repeat runs, each measured on its own
+    # run, as -X importtime slows the process down.
+    imports = wall = None
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, "-X", "importtime"] + command, cwd=ROOT,
+                             input=stdin, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+        seconds = top_level_seconds(run.stderr.decode("utf-8", errors="replace"))
+        imports = seconds if imports is None else min(imports, seconds)
+        start = time.perf_counter()
+        run = subprocess.run([sys.executable] + command, cwd=ROOT, input=stdin,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        if run.returncode != 0:
+            raise RuntimeError("{} exited with status {}".format(" ".join(command),
+                                                                  run.returncode))
+        wall = seconds if wall is None else min(wall, seconds)
+    return imports, wall
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def benchmark(args, work_dir):
+    sample = os.path.join(work_dir, "sample.md")
+    with open(sample, mode="w", encoding="utf-8") as sampleFile:
+        sampleFile.write(SAMPLE)
+    app = os.path.join(ROOT, "app.py")
+    # The client spawns its daemon on the first run, the measured runs
+    # connect to it.
+    daemon = [app, "client", "--port", str(free_port()), "--socket", "",
+              "--auto-daemon", "--exit-after-idle", "60"]
+    commands = {"batch": ([app, "batch", "--cache-dir", os.path.join(work_dir, "cache"),
+                           sample], None),
+                "check": ([app, "check", sample], None),
+                "client": (daemon + [sample], None),
+                "lsp": ([app, "lsp"], lsp_session())}
+    names = args.commands.split(",")
+    # check passes on a formatted sample.
+    subprocess.run([sys.executable, app, "batch", "--no-cache", "--in-place", sample],
+                   cwd=ROOT, check=True, stderr=subprocess.DEVNULL)
+    base_imports, base_wall = measure(["-c", "pass"], None, args.repeat)
+    runs = []
+    try:
+        if "client" in names:
+            subprocess.run([sys.executable] + daemon + [sample], cwd=ROOT, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for name in names:
+            command, stdin = commands[name]
+            imports, wall = measure(command, stdin, args.repeat)
+            runs.append({"command": name,
+                         "import_ms": (imports - base_imports) * 1000,
+                         "wall_ms": (wall - base_wall) * 1000,
+                         "budget_ms": args.budgets[name]})
+    finally:
+        if "client" in names:
+            stop_daemon(daemon)
+    return runs
+
+
+def stop_daemon(client):
+    stats = subprocess.run([sys.executable] + client[:-2] + ["--stats"], cwd=ROOT,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if stats.returncode == 0:
+        os.kill(json.loads(stats.stdout)["pid"], signal.SIGTERM)
+
+
+def parse_budget(value):
+    name, _, ms = value.partition("=")
+    if name not in BUDGETS:
+        raise argparse.ArgumentTypeError("unknown command {}".format(name))
+    return name, float(ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of each subcommand on a "
+                                     "small input and check its imports against a budget.")
+    parser.add_argument("--commands",
+                        help="Comma separated subcommands.",
+                        default=",".join(BUDGETS))
+    parser.add_argument("--budget",
+                        help="Import budget of a subcommand in milliseconds, as NAME=MS.",
+                        type=parse_budget,
+                        action="append",
+                        default=[])
+    parser.add_argument("--repeat",
+                        help="Runs per measurement, the best is reported.",
+                        type=int,
+                        default=5)
+    parser.add_argument("-o", "--output",
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+    args.budgets = dict(BUDGETS, **dict(args.budget))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        runs = benchmark(args, work_dir)
+    print("{:>8} {:>10} {:>10} {:>10}".format("command", "import ms", "budget ms", "wall ms"))
+    over = 0
+    for run in runs:
+        exceeded = run["import_ms"] > run["budget_ms"]
+        over += exceeded
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f}{}".format(
+            run["command"], run["import_ms"], run["budget_ms"], run["wall_ms"],
+            "  over budget" if exceeded else ""))
+
+    if args.output is not None:
+        results = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "settings": {"repeat": args.repeat},
+                   "runs": runs}
+        with open(args.output, mode="w", encoding="utf-8") as outputFile:
+            json.dump(results, outputFile, indent=2)
+    if over:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import instrument
+import util
+
+from typing import Dict, Iterable, List, Tuple
+
+EXTENSIONS = (".md", ".tex")
+
+_WORKER_FORMAT_KWARGS = None
+_WORKER_STREAM = False
+_WORKER_CHECK = None
+
+
+def read_file_list(path: str) -> List[str]:
+    with open(path, mode="r", encoding="utf-8") as listFile:
+        return [l.strip() for l in listFile if l.strip()]
+
+
+def expand_inputs(inputs: Iterable[str]) -> List[Tuple[str, str]]:
+    # (input path, path relative to an output tree)
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(EXTENSIONS):
+                        path = os.path.join(root, name)
+                        paths.append((path, os.path.relpath(path, item)))
+        elif glob.has_magic(item):
+            for path in sorted(glob.glob(item, recursive=True)):
+                if os.path.isfile(path):
+                    paths.append((path, _relative_name(path)))
+        else:
+            paths.append((item, _relative_name(item)))
+    return paths
+
+
+def _relative_name(path: str) -> str:
+    rel = os.path.relpath(path)
+    if os.path.isabs(path) or rel.startswith(os.pardir):
+        return os.path.basename(path)
+    return rel
+
+
+def format_file(path: str, doc_class, out_path: str, stream: bool = False,
+                hunks: List[Tuple[int, int]] = None, **format_kwargs) -> Dict:
+    # With a fill_widths list in format_kwargs, the file is formatted at each
+    # of those widths and out_path maps every width to its output path.
+    cache = format_kwargs.get("cache")
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    # The mapping is closed before an in-place write truncates the file.
+    unchanged = False
+    with util.MappedTextSource.from_path(path) as source:
+        if hunks is not None:
+            stream = False
+            output = format_hunks(source, doc_class, hunks, **format_kwargs)
+            # Files are only rewritten when formatting changed them.
+            unchanged = out_path == path and output == source.text(0, len(source))
+            outputs = {out_path: output}
+        elif stream:
+            _stream_file(source, doc_class, out_path, **format_kwargs)
+        elif "fill_widths" in format_kwargs:
+            doc = doc_class.from_source(source)
+            formatted = doc.format_widths(format_kwargs["fill_widths"], **format_kwargs)
+            outputs = {out_path[width]: "\n".join(lines) + "\n"
+                       for width, lines in formatted.items()}
+        else:
+            doc = doc_class.from_source(source)
+            outputs = {out_path: "\n".join(doc.format_out(**format_kwargs)) + "\n"}
+        result = {"path": path, "lines": len(source), "bytes": len(source.buffer)}
+    instrument.count("bytes_in", result["bytes"])
+    if cache is not None:
+        cache.flush()
+        result["cache_hits"] = cache.hits - hits
+        result["cache_misses"] = cache.misses - misses
+    parse_cache = format_kwargs.get("parse_cache")
+    if parse_cache is not None:
+        parse_cache.flush()
+    if not stream:
+        for out_path, output in outputs.items():
+            if instrument.ENABLED:
+                instrument.count("bytes_out", len(output.encode("utf-8")))
+            if out_path is None:
+                result["output"] = output
+            elif not unchanged:
+                out_dir = os.path.dirname(out_path)
+                if out_dir:
+                    os.makedirs(out_dir, exist_ok=True)
+                with open(out_path, mode="w", encoding="utf-8") as outputFile:
+                    outputFile.write(output)
+    if instrument.ENABLED:
+        # Worker processes send their numbers back with each result.
+        result["profile"] = instrument.STATS.take()
+    return result
+
+
+def format_hunks(source: util.MappedTextSource, doc_class,
+                 hunks: List[Tuple[int, int]], **format_kwargs) -> str:
+    # Formats the regions overlapping the sorted line ranges [start, end) of
+    # hunks, the rest of the source is copied as it is. Of a paragraph
+    # region only the paragraphs the hunks overlap are formatted. Blank lines
+    # around a formatted region are kept, so its spacing to its neighbours
+    # is too.
+    from process import ParagraphRegion
+    touched = []
+    line = 0
+    i = 0
+    for region in doc_class.iter_regions(source):
+        end = line + len(region.lines)
+        while i < len(hunks) and hunks[i][1] <= line:
+            i += 1
+        if i < len(hunks) and hunks[i][0] < end:
+            if isinstance(region, ParagraphRegion):
+                touched.extend(_touched_paragraphs(line, region, hunks[i:]))
+            else:
+                touched.append((line, region))
+        line = end
+    if not touched:
+        return source.text(0, len(source))
+
+    doc = doc_class([region for line, region in touched])
+    kwargs = doc.get_format_config(**format_kwargs)
+    doc_class.parse_docs([(doc, kwargs)])
+    pieces = []
+    copied = 0
+    for line, region in touched:
+        content = [j for j, l in enumerate(region.lines) if l]
+        if not content:
+            continue
+        pieces.append(source.text(copied, line + content[0]))
+        pieces.extend(l + "\n" for l in region.format_out(**kwargs))
+        copied = line + content[-1] + 1
+    pieces.append(source.text(copied, len(source)))
+    return "".join(pieces)
+
+
+def _touched_paragraphs(line: int, region, hunks: List[Tuple[int, int]]) -> List[Tuple]:
+    # The paragraphs of a region starting at line that hunks overlap, each as
+    # a region of its own. A hunk of only blank lines, such as one splitting
+    # a paragraph, touches the paragraphs on either side of it.
+    spans = []
+    start = 0
+    for paragraph in region.paragraphs:
+        while region.lines[start] == "":
+            start += 1
+        spans.append((line + start, line + start + len(paragraph.lines), paragraph))
+        start += len(paragraph.lines)
+    marked = set()
+    end = line + len(region.lines)
+    for hunk_start, hunk_end in hunks:
+        if hunk_start >= end:
+            break
+        overlapping = [k for k, (first, last, p) in enumerate(spans)
+                       if hunk_start < last and first < hunk_end]
+        if not overlapping:
+            after = sum(1 for first, last, p in spans if last <= hunk_start)
+            overlapping = [k for k in (after - 1, after) if 0 <= k < len(spans)]
+        marked.update(overlapping)
+    return [(spans[k][0], type(region)(spans[k][2].lines)) for k in sorted(marked)]
+
+
+def check_file(path: str, doc_class, check_all: bool = False, **format_kwargs) -> Dict:
+    with util.MappedTextSource.from_path(path) as source:
+        differences = check_source(source, doc_class, check_all, **format_kwargs)
+        result = {"path": path, "lines": len(source), "bytes": len(source.buffer),
+                  "differences": differences}
+    instrument.count("bytes_in", result["bytes"])
+    if instrument.ENABLED:
+        result["profile"] = instrument.STATS.take()
+    return result
+
+
+def check_source(source: util.MappedTextSource, doc_class, check_all: bool = False,
+                 **format_kwargs) -> List[int]:
+    # Compares the formatted output with the source one region at a time,
+    # returning the 1-based source lines where they first differ. Stops at
+    # the first difference unless check_all, then the comparison resumes
+    # after the content of the differing region.
+    differences = []
+    line = 0
+    first = True
+    produced = False
+    for chunk, kwargs in _parsed_chunks(source, doc_class, **format_kwargs):
+        for start, region in chunk:
+            expected = list(region.format_out(**kwargs))
+            if not first:
+                expected.insert(0, "")
+            first = False
+            if not expected:
+                continue
+            produced = True
+            end = line + len(expected)
+            if end <= len(source) and source.text(line, end) == "\n".join(expected) + "\n":
+                line = end
+                continue
+            for expected_line in expected:
+                if line >= len(source) or source.text(line, line + 1) != expected_line + "\n":
+                    break
+                line += 1
+            differences.append(line + 1)
+            if not check_all:
+                return differences
+            content = [i for i, l in enumerate(region.lines) if l]
+            line = start + (content[-1] + 1 if content else len(region.lines))
+    if not produced:
+        # Empty output is written as one empty line.
+        if len(source) == 0 or source.text(0, 1) != "\n":
+            return [1]
+        line = 1
+    if line < len(source):
+        differences.append(line + 1)
+    return differences
+
+
+def _parsed_chunks(source: util.MappedTextSource, doc_class, **format_kwargs):
+    # Yields (start line, region) lists holding about batch_size paragraphs,
+    # parsed together, so checks stop early without giving up batching.
+    batch_size = format_kwargs.get("batch_size", 64)
+    chunk = []
+    paragraphs = 0
+    line = 0
+    for region in doc_class.iter_regions(source):
+        chunk.append((line, region))
+        line += len(region.lines)
+        paragraphs += sum(1 for p in region.get_paragraphs())
+        if paragraphs >= batch_size:
+            yield chunk, _parse_regions(chunk, doc_class, format_kwargs)
+            chunk = []
+            paragraphs = 0
+    if chunk:
+        yield chunk, _parse_regions(chunk, doc_class, format_kwargs)
+
+
+def _parse_regions(chunk, doc_class, format_kwargs) -> Dict:
+    doc = doc_class([region for line, region in chunk])
+    kwargs = doc.get_format_config(**format_kwargs)
+    doc_class.parse_docs([(doc, kwargs)])
+    return kwargs
+
+
+def _stream_file(source, doc_class, out_path: str, **format_kwargs):
+    regions = doc_class.format_regions(source, **format_kwargs)
+    if out_path is None:
+        write_regions(regions, sys.stdout)
+        return
+    out_dir = os.path.dirname(out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    # The output may replace the input that is still being read, so it goes
+    # to a temporary file that is moved over the output path when complete.
+    with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=out_dir or ".",
+                                     prefix=".slb-", delete=False) as outputFile:
+        try:
+            write_regions(regions, outputFile)
+        except BaseException:
+            outputFile.close()
+            os.remove(outputFile.name)
+            raise
+    os.replace(outputFile.name, out_path)
+
+
+def write_regions(regions: Iterable[List[str]], out):
+    # Writes the same text as joining Doc.format_out, flushing every region.
+    # Regions of blank lines have no output lines, when no line at all is
+    # written the output is a single empty line.
+    first = True
+    written = False
+    for lines in regions:
+        if not first:
+            out.write("\n")
+            written = True
+        first = False
+        for line in lines:
+            out.write(line)
+            out.write("\n")
+            if instrument.ENABLED:
+                instrument.count("bytes_out", len(line.encode("utf-8")) + 1)
+        written = written or bool(lines)
+        out.flush()
+    if not written:
+        out.write("\n")
+
+
+def _init_worker(format_kwargs, stream=False, profile=False, check=None):
+    global _WORKER_FORMAT_KWARGS, _WORKER_STREAM, _WORKER_CHECK
+    _WORKER_FORMAT_KWARGS = format_kwargs
+    _WORKER_STREAM = stream
+    _WORKER_CHECK = check
+    instrument.enable(profile)
+    format_kwargs["tokenizer"].warm_up()
+
+
+def _format_job(job):
+    path, doc_class, out_path = job[:3]
+    hunks = job[3] if len(job) > 3 else None
+    try:
+        if _WORKER_CHECK is not None:
+            return check_file(path, doc_class, _WORKER_CHECK, **_WORKER_FORMAT_KWARGS)
+        return format_file(path, doc_class, out_path, _WORKER_STREAM, hunks,
+                           **_WORKER_FORMAT_KWARGS)
+    except Exception as e:
+        return {"path": path, "error": "{}: {}".format(type(e).__name__, e)}
+
+
+def run(jobs: List[Tuple], format_kwargs: Dict, workers: int = None,
+        stream: bool = False, profile: bool = False, check: bool = None) -> Iterable[Dict]:
+    # jobs are (path, doc class, output path) with an optional fourth item,
+    # the changed line ranges to limit formatting to; results come back in
+    # order. Streamed jobs without an output path write to stdout as they go.
+    # With check set, files are only checked, see check_file.
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if stream and any(job[2] is None for job in jobs):
+        workers = 1
+    if workers <= 1:
+        _init_worker(format_kwargs, stream, profile, check)
+        yield from map(_format_job, jobs)
+        return
+    # Imported here, a single file doesn't start a pool.
+    import concurrent.futures
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(format_kwargs, stream,
+                                                          profile, check)) as pool:
+        yield from pool.map(_format_job, jobs, chunksize=chunksize)
+
+
+class Throughput:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = 0
+        self.lines = 0
+        self.bytes = 0
+        self.errors = 0
+        self.cache_hits = None
+        self.cache_misses = None
+
+    def add(self, result: Dict):
+        if "error" in result:
+            self.errors += 1
+            return
+        self.files += 1
+        self.lines += result["lines"]
+        self.bytes += result["bytes"]
+        if "cache_hits" in result:
+            self.cache_hits = (self.cache_hits or 0) + result["cache_hits"]
+            self.cache_misses = (self.cache_misses or 0) + result["cache_misses"]
+
+    def report(self, out=sys.stderr):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print("{} files, {} lines, {:.1f} KiB in {:.2f}s "
+              "({:.1f} files/s, {:.0f} lines/s){}"
+              .format(self.files, self.lines, self.bytes / 1024, elapsed,
+                      self.files / elapsed, self.lines / elapsed,
+                      ", {} failed".format(self.errors) if self.errors else ""),
+              file=out)
+        if self.cache_hits is not None:
+            print("paragraph cache: {} hits, {} misses"
+                  .format(self.cache_hits, self.cache_misses), file=out)
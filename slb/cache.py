@@ -0,0 +1,271 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import instrument
+import nlp
+
+from typing import Dict, Iterable, List
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                                os.path.expanduser("~/.cache")),
+                                 "slb")
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ParagraphCache:
+    FILE_NAME = "paragraphs.sqlite3"
+    QUERY_CHUNK = 500
+    # Pending writes are flushed at this size, so long streams stay bounded.
+    FLUSH_ENTRIES = 1024
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.pending = dict()
+        self.touched = set()
+        self._connection = None
+
+    def __getstate__(self):
+        # Connections do not survive pickling, worker processes open their own.
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["pending"] = dict()
+        state["touched"] = set()
+        return state
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, self.FILE_NAME)
+            self._connection = sqlite3.connect(path, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS paragraphs ("
+                                     "key TEXT PRIMARY KEY, "
+                                     "lines TEXT NOT NULL, "
+                                     "size INTEGER NOT NULL, "
+                                     "used REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS paragraphs_used "
+                                     "ON paragraphs (used)")
+        return self._connection
+
+    @staticmethod
+    def make_key(text: str, **kwargs) -> str:
+        tokenizer = kwargs.get("tokenizer", nlp.Tokenizer)
+        allocator = kwargs.get("allocator", nlp.Allocator)
+        settings = [text,
+                    kwargs.get("fill_width", 80),
+                    "{}.{}".format(tokenizer.__module__, tokenizer.__qualname__),
+                    "{}.{}".format(allocator.__module__, allocator.__qualname__),
+                    tokenizer.model_id()]
+        return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+    def get_many(self, paragraphs: Iterable, **kwargs) -> Dict:
+        keyed = dict()
+        for paragraph in paragraphs:
+            keyed.setdefault(self.make_key(paragraph.text, **kwargs), []).append(paragraph)
+        keys = list(keyed)
+        found = dict()
+        for i in range(0, len(keys), self.QUERY_CHUNK):
+            chunk = keys[i: i + self.QUERY_CHUNK]
+            rows = self.connection.execute(
+                "SELECT key, lines FROM paragraphs WHERE key IN ({})"
+                .format(",".join("?" * len(chunk))), chunk)
+            for key, lines in rows:
+                found[key] = json.loads(lines)
+        for key in keys:
+            if key in self.pending:
+                found[key] = self.pending[key]
+
+        formatted = dict()
+        for key, group in keyed.items():
+            if key in found:
+                self.hits += len(group)
+                self.touched.add(key)
+                for paragraph in group:
+                    formatted[paragraph] = found[key]
+            else:
+                self.misses += len(group)
+        if len(self.touched) >= self.FLUSH_ENTRIES:
+            self.flush()
+        return formatted
+
+    def put(self, text: str, lines: List[str], **kwargs):
+        self.pending[self.make_key(text, **kwargs)] = list(lines)
+        if len(self.pending) >= self.FLUSH_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        now = time.time()
+        with self.connection as connection:
+            rows = []
+            for key, lines in self.pending.items():
+                value = json.dumps(lines)
+                rows.append((key, value, len(value), now))
+            connection.executemany("INSERT OR REPLACE INTO paragraphs "
+                                   "VALUES (?, ?, ?, ?)", rows)
+            connection.executemany("UPDATE paragraphs SET used = ? WHERE key = ?",
+                                   ((now, key) for key in self.touched))
+            self._evict(connection)
+        self.pending = dict()
+        self.touched = set()
+
+    def _evict(self, connection):
+        total, = connection.execute("SELECT COALESCE(SUM(size), 0) FROM paragraphs").fetchone()
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for key, size in connection.execute("SELECT key, size FROM paragraphs ORDER BY used"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM paragraphs WHERE key = ?", victims)
+
+    def close(self):
+        if self.pending or self.touched:
+            self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class MemoryParagraphCache:
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+
+    def get_many(self, paragraphs: Iterable, **kwargs) -> Dict:
+        formatted = dict()
+        for paragraph in paragraphs:
+            key = ParagraphCache.make_key(paragraph.text, **kwargs)
+            lines = self.entries.get(key)
+            if lines is None:
+                self.misses += 1
+                continue
+            self.hits += 1
+            self.entries.move_to_end(key)
+            formatted[paragraph] = lines
+        return formatted
+
+    def put(self, text: str, lines: List[str], **kwargs):
+        key = ParagraphCache.make_key(text, **kwargs)
+        self.entries[key] = list(lines)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ParseStore(ParagraphCache):
+    # ParagraphCache's table in its own file, its lines column holding
+    # encoded parses.
+    FILE_NAME = "parses.sqlite3"
+
+    @staticmethod
+    def make_key(text: str, **kwargs) -> str:
+        return ParseCache.make_key(text, **kwargs)
+
+    def put(self, text: str, parse: Dict, **kwargs):
+        self.pending[self.make_key(text, **kwargs)] = parse
+        if len(self.pending) >= self.FLUSH_ENTRIES:
+            self.flush()
+
+
+class ParseCache:
+    # Parses of paragraphs, which hold for every fill width and allocator
+    # sharing the break taggers. Kept in memory, without a bound when
+    # max_entries is None, and also in a ParseStore under cache_dir when one
+    # is given. Daemon workers share one cache.
+    def __init__(self, max_entries: int = 4096, cache_dir: str = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.store = ParseStore(cache_dir, max_bytes) if cache_dir is not None else None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes start with an empty memory cache.
+        state = self.__dict__.copy()
+        state["entries"] = collections.OrderedDict()
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text: str, **kwargs) -> str:
+        tokenizer = kwargs.get("tokenizer", nlp.Tokenizer)
+        allocator = kwargs.get("allocator", nlp.Allocator)
+        settings = [text,
+                    "{}.{}".format(tokenizer.__module__, tokenizer.__qualname__),
+                    allocator.tagger_id(),
+                    tokenizer.model_id()]
+        return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+    def get_many(self, paragraphs: Iterable, **kwargs) -> Dict:
+        parsed = dict()
+        missing = []
+        with self.lock:
+            for paragraph in paragraphs:
+                key = self.make_key(paragraph.text, **kwargs)
+                parse = self.entries.get(key)
+                if parse is None:
+                    missing.append(paragraph)
+                    continue
+                self.entries.move_to_end(key)
+                parsed[paragraph] = parse
+            if missing and self.store is not None:
+                stored = self.store.get_many(missing, **kwargs)
+                for paragraph, encoded in stored.items():
+                    parse = nlp.Parse.from_dict(encoded, **kwargs)
+                    self._remember(self.make_key(paragraph.text, **kwargs), parse)
+                    parsed[paragraph] = parse
+                missing = [p for p in missing if p not in stored]
+            self.hits += len(parsed)
+            self.misses += len(missing)
+        instrument.count("parse_cache.hits", len(parsed))
+        instrument.count("parse_cache.misses", len(missing))
+        return parsed
+
+    def put(self, text: str, parse: "nlp.Parse", **kwargs):
+        with self.lock:
+            self._remember(self.make_key(text, **kwargs), parse)
+            if self.store is not None:
+                self.store.put(text, parse.to_dict(), **kwargs)
+
+    def _remember(self, key: str, parse: "nlp.Parse"):
+        self.entries[key] = parse
+        self.entries.move_to_end(key)
+        while self.max_entries is not None and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        if self.store is not None:
+            with self.lock:
+                self.store.flush()
+
+    def close(self):
+        if self.store is not None:
+            with self.lock:
+                self.store.close()
@@ -0,0 +1,80 @@
+import codecs
+import os
+import re
+import subprocess
+
+from typing import Dict, Iterable, List, Tuple
+
+FILE_RE = re.compile(r"\+\+\+ (.*)$")
+HUNK_RE = re.compile(r"@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+def git(args: List[str], cwd: str = None) -> str:
+    return subprocess.run(["git"] + args, cwd=cwd, check=True,
+                          encoding="utf-8", errors="replace", stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+
+def changed_hunks(rev: str = None, paths: Iterable[str] = (),
+                  cwd: str = None) -> Dict[str, List[Tuple[int, int]]]:
+    # Changed line ranges [start, end) of the working tree files against rev,
+    # or against the index without one. Paths are relative to cwd.
+    root = git(["rev-parse", "--show-toplevel"], cwd).strip()
+    args = ["diff", "--unified=0", "--no-color", "--no-ext-diff", "--no-renames",
+            "--diff-filter=d", "--src-prefix=a/", "--dst-prefix=b/"]
+    if rev:
+        args.append(rev)
+    diff = git(args + ["--"] + list(paths), cwd)
+    return {os.path.relpath(os.path.join(root, path), cwd or os.curdir): hunks
+            for path, hunks in parse_diff(diff).items()}
+
+
+def parse_diff(diff: str) -> Dict[str, List[Tuple[int, int]]]:
+    files = dict()
+    hunks = None
+    in_header = False
+    for line in diff.split("\n"):
+        # An added line can look like a file header, so those are only
+        # matched between "diff --git" and the first hunk.
+        if line.startswith("diff --git "):
+            in_header = True
+            hunks = None
+            continue
+        if in_header:
+            m = FILE_RE.match(line)
+            if m is not None:
+                path = _unquote(m.group(1))
+                if path.startswith("b/"):
+                    hunks = files.setdefault(path[2:], [])
+                continue
+        m = HUNK_RE.match(line)
+        if m is None:
+            continue
+        in_header = False
+        if hunks is None:
+            continue
+        start = int(m.group(1))
+        count = int(m.group(2)) if m.group(2) is not None else 1
+        if count == 0:
+            # Lines were only removed after line start, so the lines on both
+            # sides of the removal count as changed.
+            hunks.append((max(start - 1, 0), start + 1))
+        else:
+            hunks.append((start - 1, start - 1 + count))
+    return {path: merge_ranges(hunks) for path, hunks in files.items()}
+
+
+def _unquote(path: str) -> str:
+    # Paths with unusual characters are quoted with C escapes.
+    if path.startswith('"') and path.endswith('"'):
+        return codecs.escape_decode(path[1:-1])[0].decode("utf-8")
+    return path
+
+
+def merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
@@ -0,0 +1,175 @@
+import cache
+import itertools
+
+from process import Doc, TextRegion
+from util import FileTextSource
+from typing import Iterable, List
+
+
+class Patch:
+    def __init__(self, start: int, end: int, lines: List[str]):
+        # Replace output lines [start, end) with lines.
+        self.start = start
+        self.end = end
+        self.lines = lines
+
+    def apply(self, lines: List[str]) -> List[str]:
+        return lines[:self.start] + self.lines + lines[self.end:]
+
+    def to_dict(self):
+        return {"start": self.start, "end": self.end, "lines": self.lines}
+
+
+class IncrementalDoc:
+    # Keeps the source lines, regions and per-region output of a document so
+    # that an edit only re-detects and reflows the regions around it.
+    def __init__(self, doc_class, lines: Iterable[str], **format_kwargs):
+        self.doc_class = doc_class
+        if "cache" not in format_kwargs:
+            format_kwargs["cache"] = cache.MemoryParagraphCache()
+        self.format_kwargs = format_kwargs
+        self.lines = [l.rstrip() for l in lines]
+        self.regions = []
+        self.outputs = []
+        # Each region's first source line, and its offset in the output if
+        # every region was preceded by a separator line. An edit shifts the
+        # regions after it lazily: those from shift_from on are behind by
+        # line_shift and output_shift, see region_start and _move_shift.
+        self.region_starts = []
+        self.output_offsets = []
+        self.shift_from = 0
+        self.line_shift = 0
+        self.output_shift = 0
+        regions, last = self._scan(0, None, 0)
+        self._replace_regions(0, 0, regions, 0)
+
+    @classmethod
+    def from_text(cls, doc_class, text: str, **format_kwargs):
+        return cls(doc_class, cls._split_text(text), **format_kwargs)
+
+    @staticmethod
+    def _split_text(text: str) -> List[str]:
+        lines = text.split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        return lines
+
+    def output_lines(self) -> List[str]:
+        lines = []
+        for i, output in enumerate(self.outputs):
+            if i > 0:
+                lines.append("")
+            lines.extend(output)
+        return lines
+
+    def apply_edit(self, start: int, end: int, new_text: str) -> Patch:
+        # Replaces source lines [start, end) with new_text and returns the
+        # change to output_lines().
+        start = max(0, min(start, len(self.lines)))
+        end = max(start, min(end, len(self.lines)))
+        new_lines = [l.rstrip() for l in self._split_text(new_text)]
+        delta = len(new_lines) - (end - start)
+        old_lines = self.lines[start:end]
+        self.lines[start:end] = new_lines
+
+        # A region's extent only depends on the lines from its first line on,
+        # so scanning restarts at the region holding the line before the edit.
+        first = self.region_at(start - 1) if start > 0 else 0
+        scan_from = self.region_start(first) if self.regions else 0
+        resync = max(first + 1, self.region_at(end - 1) + 1 if end > 0 else 0)
+        try:
+            regions, last = self._scan(scan_from, resync, delta)
+        except Exception:
+            self.lines[start:start + len(new_lines)] = old_lines
+            raise
+        if last is None:
+            last = len(self.regions)
+        return self._replace_regions(first, last, regions, delta)
+
+    def region_start(self, i: int) -> int:
+        return self.region_starts[i] + (self.line_shift if i >= self.shift_from else 0)
+
+    def region_at(self, line: int) -> int:
+        # The region holding source line line.
+        lo, hi = 0, len(self.region_starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.region_start(mid) <= line:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def _scan(self, start: int, resync, delta: int):
+        # Detects regions from source line start, stopping as soon as a region
+        # begins where an unchanged old region, from region resync on, began
+        # before the edit moved it by delta lines. Only the old regions up to
+        # the last line scanned are looked at.
+        source = FileTextSource(itertools.islice(self.lines, start, None))
+        regions = []
+        line = start
+        for region in self.doc_class.iter_regions(source):
+            while resync is not None and resync < len(self.regions) \
+                    and self.region_start(resync) + delta < line:
+                resync += 1
+            if resync is not None and resync < len(self.regions) \
+                    and self.region_start(resync) + delta == line:
+                return regions, resync
+            regions.append((line, region))
+            line += len(region.lines)
+        return regions, None
+
+    def _output_offset(self, i: int) -> int:
+        if i == len(self.outputs):
+            return self._output_offset(i - 1) + len(self.outputs[i - 1]) + 1 if i > 0 else 0
+        return self.output_offsets[i] + (self.output_shift if i >= self.shift_from else 0)
+
+    def _output_start(self, i: int) -> int:
+        # Every region but the first is preceded by an empty separator line.
+        return self._output_offset(i) - (1 if i > 0 else 0)
+
+    def _move_shift(self, i: int):
+        # Makes the regions before i exact and the shift apply from i on, in
+        # time proportional to how far the shift moves.
+        for j in range(self.shift_from, i):
+            self.region_starts[j] += self.line_shift
+            self.output_offsets[j] += self.output_shift
+        for j in range(i, self.shift_from):
+            self.region_starts[j] -= self.line_shift
+            self.output_offsets[j] -= self.output_shift
+        self.shift_from = i
+
+    def _replace_regions(self, first: int, last: int, regions, delta: int) -> Patch:
+        outputs = self._format_regions([region for line, region in regions])
+        self._move_shift(last)
+        out_start = self._output_start(first)
+        out_end = self._output_start(last)
+        patch_lines = []
+        offsets = []
+        offset = self._output_offset(first)
+        for i, output in enumerate(outputs):
+            if first + i > 0:
+                patch_lines.append("")
+            patch_lines.extend(output)
+            offsets.append(offset)
+            offset += len(output) + 1
+        output_delta = offset - self._output_offset(last)
+        if first == 0 and not outputs and last < len(self.outputs):
+            out_end += 1
+
+        self.regions[first:last] = [region for line, region in regions]
+        self.region_starts[first:last] = [line for line, region in regions]
+        self.output_offsets[first:last] = offsets
+        self.outputs[first:last] = outputs
+        self.shift_from = first + len(regions)
+        self.line_shift += delta
+        self.output_shift += output_delta
+        return Patch(out_start, out_end, patch_lines)
+
+    def _format_regions(self, regions: List[TextRegion]) -> List[List[str]]:
+        if not regions:
+            return []
+        doc = self.doc_class(regions)
+        kwargs = doc.get_format_config(**self.format_kwargs)
+        Doc.parse_docs([(doc, kwargs)])
+        return [list(region.format_out(**kwargs)) for region in regions]
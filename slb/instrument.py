@@ -0,0 +1,100 @@
+import collections
+import functools
+import sys
+import threading
+import time
+
+from typing import Dict
+
+# Instrumentation is off unless enabled, then start() returns None and
+# stop() and count() return right away.
+ENABLED = False
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = collections.Counter()
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.timers[name] += seconds
+            self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {"timers": dict(self.timers),
+                    "calls": dict(self.calls),
+                    "counters": dict(self.counters)}
+
+    def take(self) -> Dict:
+        with self.lock:
+            snapshot = {"timers": dict(self.timers),
+                        "calls": dict(self.calls),
+                        "counters": dict(self.counters)}
+            self.timers.clear()
+            self.calls.clear()
+            self.counters.clear()
+        return snapshot
+
+    def merge(self, snapshot: Dict):
+        with self.lock:
+            self.timers.update(snapshot["timers"])
+            self.calls.update(snapshot["calls"])
+            self.counters.update(snapshot["counters"])
+
+    def report(self, out=sys.stderr):
+        snapshot = self.snapshot()
+        if snapshot["timers"]:
+            print("stage                    seconds      calls", file=out)
+            for name, seconds in sorted(snapshot["timers"].items(), key=lambda i: -i[1]):
+                print("{:<20} {:>11.4f} {:>10}".format(name, seconds, snapshot["calls"][name]),
+                      file=out)
+        if snapshot["counters"]:
+            print("counter                        total", file=out)
+            for name, total in sorted(snapshot["counters"].items()):
+                print("{:<26} {:>10}".format(name, total), file=out)
+
+
+STATS = Stats()
+
+
+def enable(enabled: bool = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def start():
+    return time.perf_counter() if ENABLED else None
+
+
+def stop(name: str, started):
+    if started is not None:
+        STATS.add_time(name, time.perf_counter() - started)
+
+
+def count(name: str, n: int = 1):
+    if ENABLED:
+        STATS.count(name, n)
+
+
+def timed(name: str):
+    # Decorator timing every call of a function under name.
+    def decorate(f):
+        @functools.wraps(f)
+        def timed_f(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                STATS.add_time(name, time.perf_counter() - started)
+        return timed_f
+    return decorate
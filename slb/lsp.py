@@ -0,0 +1,303 @@
+import json
+import os
+import sys
+import traceback
+import md
+import nlp
+import tex
+
+from incremental import IncrementalDoc
+from typing import Dict, List
+
+# Language Server Protocol over stdio. Messages are JSON-RPC bodies after a
+# Content-Length header. Only whole-document and range formatting are
+# offered, documents are synced incrementally.
+METHOD_NOT_FOUND = -32601
+SERVER_NOT_INITIALIZED = -32002
+REQUEST_FAILED = -32803
+SYNC_INCREMENTAL = 2
+
+LANGUAGE_FORMATS = {"markdown": md.MdDoc,
+                    "latex": tex.TexDoc,
+                    "tex": tex.TexDoc}
+EXTENSION_FORMATS = {".md": md.MdDoc,
+                     ".markdown": md.MdDoc,
+                     ".tex": tex.TexDoc}
+
+
+def read_message(stream) -> Dict:
+    # None once the client closes the stream.
+    length = None
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    if length is None:
+        raise ValueError("message without Content-Length")
+    body = stream.read(length)
+    if len(body) < length:
+        return None
+    return json.loads(body)
+
+
+def write_message(stream, message: Dict):
+    body = json.dumps(message).encode("utf-8")
+    stream.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    stream.flush()
+
+
+def to_index(line: str, character: int, encoding: str) -> int:
+    # Index into line of a position's character offset, which counts code
+    # units of the negotiated encoding.
+    if encoding == "utf-32" or line.isascii():
+        return min(character, len(line))
+    if encoding == "utf-8":
+        return len(line.encode("utf-8")[:character].decode("utf-8", errors="ignore"))
+    units = 0
+    for i, c in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(c) > 0xFFFF else 1
+    return len(line)
+
+
+def from_index(line: str, index: int, encoding: str) -> int:
+    if encoding == "utf-32" or line.isascii():
+        return index
+    if encoding == "utf-8":
+        return len(line[:index].encode("utf-8"))
+    return len(line[:index].encode("utf-16-le")) // 2
+
+
+class Document:
+    # An open document's lines as the editor has them, and an IncrementalDoc
+    # of its regions and their output. Changes only edit the lines, the
+    # regions are brought up to date when formatting is asked for, with all
+    # changes since as one edit of the lines between the first and the last
+    # that differ.
+    def __init__(self, doc_class, text: str, **format_kwargs):
+        self.doc_class = doc_class
+        self.format_kwargs = format_kwargs
+        self.lines = text.split("\n")
+        self.incremental = None
+        self.synced = None
+        try:
+            self.sync()
+        except Exception:
+            # Reported when the document is formatted.
+            pass
+
+    def change(self, change: Dict, encoding: str):
+        if "range" not in change:
+            self.lines = change["text"].split("\n")
+            return
+        start = change["range"]["start"]
+        end = change["range"]["end"]
+        first = min(start["line"], len(self.lines) - 1)
+        last = min(end["line"], len(self.lines) - 1)
+        head = self.lines[first][:to_index(self.lines[first], start["character"], encoding)]
+        tail = self.lines[last][to_index(self.lines[last], end["character"], encoding):]
+        self.lines[first: last + 1] = (head + change["text"] + tail).split("\n")
+
+    def source_lines(self) -> List[str]:
+        # A final newline doesn't start another line of the document.
+        return self.lines[:-1] if self.lines[-1] == "" else list(self.lines)
+
+    def sync(self) -> IncrementalDoc:
+        lines = self.source_lines()
+        if self.incremental is None:
+            self.incremental = IncrementalDoc(self.doc_class, lines, **self.format_kwargs)
+            self.synced = lines
+            return self.incremental
+        old = self.synced
+        n = min(len(old), len(lines))
+        start = 0
+        while start < n and old[start] == lines[start]:
+            start += 1
+        if start == len(old) == len(lines):
+            return self.incremental
+        same = 0
+        while same < n - start and old[-1 - same] == lines[-1 - same]:
+            same += 1
+        self.incremental.apply_edit(start, len(old) - same,
+                                    "".join(l + "\n" for l in lines[start: len(lines) - same]))
+        self.synced = lines
+        return self.incremental
+
+    def format_edits(self, encoding: str) -> List[Dict]:
+        # One edit from the first to the last line that formatting changes.
+        # The output ends with a newline, like the batch output.
+        target = self.sync().output_lines() + [""]
+        lines = self.lines
+        n = min(len(lines), len(target))
+        start = 0
+        while start < n and lines[start] == target[start]:
+            start += 1
+        if start == len(lines) == len(target):
+            return []
+        same = 0
+        while same < n - start and lines[-1 - same] == target[-1 - same]:
+            same += 1
+        return [self._replace(start, len(lines) - same, target[start: len(target) - same],
+                              encoding)]
+
+    def range_edits(self, range_: Dict, encoding: str) -> List[Dict]:
+        # Regions overlapping the range get their output, from their first to
+        # their last line of content. Other lines are left as they are.
+        incremental = self.sync()
+        first = range_["start"]["line"]
+        last = range_["end"]["line"]
+        if range_["end"]["character"] == 0 and last > first:
+            last -= 1
+        edits = []
+        for i in range(incremental.region_at(first), len(incremental.regions)):
+            start = incremental.region_start(i)
+            region = incremental.regions[i]
+            output = incremental.outputs[i]
+            if start > last:
+                break
+            if start + len(region.lines) <= first:
+                continue
+            content = [j for j, l in enumerate(region.lines) if l]
+            if not content:
+                continue
+            begin = start + content[0]
+            end = start + content[-1] + 1
+            if self.lines[begin:end] != output:
+                edits.append(self._replace(begin, end, output, encoding))
+        return edits
+
+    def _replace(self, start: int, end: int, new_lines: List[str], encoding: str) -> Dict:
+        # An edit replacing lines [start, end). A last line without a newline
+        # is replaced up to its end.
+        if end < len(self.lines):
+            return {"range": {"start": {"line": start, "character": 0},
+                              "end": {"line": end, "character": 0}},
+                    "newText": "".join(l + "\n" for l in new_lines)}
+        last = len(self.lines) - 1
+        return {"range": {"start": {"line": start, "character": 0},
+                          "end": {"line": last,
+                                  "character": from_index(self.lines[last],
+                                                          len(self.lines[last]), encoding)}},
+                "newText": "\n".join(new_lines)}
+
+
+class LspServer:
+    def __init__(self, format_kwargs: Dict, stdin=None, stdout=None):
+        self.format_kwargs = format_kwargs
+        self.stdin = stdin or sys.stdin.buffer
+        self.stdout = stdout or sys.stdout.buffer
+        self.documents = dict()
+        self.encoding = "utf-16"
+        self.initialized = False
+        self.shutdown_requested = False
+        self.methods = {"initialize": self.initialize,
+                        "shutdown": self.shutdown,
+                        "textDocument/didOpen": self.did_open,
+                        "textDocument/didChange": self.did_change,
+                        "textDocument/didClose": self.did_close,
+                        "textDocument/formatting": self.formatting,
+                        "textDocument/rangeFormatting": self.range_formatting}
+
+    def run(self) -> int:
+        # Returns the exit code, which is an error unless shutdown came first.
+        # The model is loaded before the first request, so that the editor
+        # doesn't wait for it on the first save.
+        self.format_kwargs.get("tokenizer", nlp.Tokenizer).warm_up()
+        while True:
+            message = read_message(self.stdin)
+            if message is None or message.get("method") == "exit":
+                return 0 if self.shutdown_requested else 1
+            response = self.handle(message)
+            if response is not None:
+                write_message(self.stdout, response)
+
+    def handle(self, message: Dict) -> Dict:
+        # Answers requests, notifications get no answer, even on errors.
+        method = message.get("method")
+        is_request = "id" in message
+        handler = self.methods.get(method)
+        try:
+            if handler is None:
+                if not is_request:
+                    return None
+                return self._error(message, METHOD_NOT_FOUND,
+                                   "unsupported method {}".format(method))
+            if not self.initialized and method != "initialize":
+                if not is_request:
+                    return None
+                return self._error(message, SERVER_NOT_INITIALIZED, "not initialized")
+            result = handler(message.get("params") or dict())
+        except Exception as e:
+            if not is_request:
+                traceback.print_exc(file=sys.stderr)
+                return None
+            return self._error(message, REQUEST_FAILED, "{}: {}".format(type(e).__name__, e))
+        if not is_request:
+            return None
+        return {"jsonrpc": "2.0", "id": message["id"], "result": result}
+
+    @staticmethod
+    def _error(message, code, text):
+        return {"jsonrpc": "2.0", "id": message.get("id"),
+                "error": {"code": code, "message": text}}
+
+    def initialize(self, params):
+        # Offsets within lines are Python string indices with UTF-32, which
+        # is taken when the client offers it.
+        encodings = params.get("capabilities", {}).get("general", {}) \
+                          .get("positionEncodings", [])
+        self.encoding = "utf-32" if "utf-32" in encodings else "utf-16"
+        options = params.get("initializationOptions") or dict()
+        if "fillWidth" in options:
+            self.format_kwargs["fill_width"] = int(options["fillWidth"])
+        self.initialized = True
+        return {"capabilities": {"positionEncoding": self.encoding,
+                                 "textDocumentSync": {"openClose": True,
+                                                      "change": SYNC_INCREMENTAL},
+                                 "documentFormattingProvider": True,
+                                 "documentRangeFormattingProvider": True},
+                "serverInfo": {"name": "slb"}}
+
+    def shutdown(self, params):
+        self.shutdown_requested = True
+        self.documents.clear()
+        return None
+
+    def did_open(self, params):
+        item = params["textDocument"]
+        self.documents[item["uri"]] = Document(self.get_doc_class(item), item["text"],
+                                               **self.format_kwargs)
+
+    def did_change(self, params):
+        document = self.get_document(params)
+        for change in params["contentChanges"]:
+            document.change(change, self.encoding)
+
+    def did_close(self, params):
+        self.documents.pop(params["textDocument"]["uri"], None)
+
+    def formatting(self, params):
+        return self.get_document(params).format_edits(self.encoding)
+
+    def range_formatting(self, params):
+        return self.get_document(params).range_edits(params["range"], self.encoding)
+
+    def get_document(self, params) -> Document:
+        uri = params["textDocument"]["uri"]
+        if uri not in self.documents:
+            raise KeyError("document {} is not open".format(uri))
+        return self.documents[uri]
+
+    @staticmethod
+    def get_doc_class(item: Dict):
+        if item.get("languageId") in LANGUAGE_FORMATS:
+            return LANGUAGE_FORMATS[item["languageId"]]
+        extension = os.path.splitext(item["uri"])[1]
+        return EXTENSION_FORMATS.get(extension, md.MdDoc)
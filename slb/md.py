@@ -19,19 +19,17 @@ class MdDoc(Doc):
     HEADER_RE = re.compile(r"^#")
     UNFLOWABLE_RE = [HEADER_RE]
 
+    # Matched against a paragraph's first line, its text is only joined once
+    # it is formatted.
     @staticmethod
     def can_flow_paragraph(paragraph: Paragraph):
-        return not any(regex.search(paragraph.text) for regex in MdDoc.UNFLOWABLE_RE)
+        line = paragraph.lines[0]
+        return not any(regex.match(line) for regex in MdDoc.UNFLOWABLE_RE)
 
 
 class MdCodeRegion(TextRegion):
-    @staticmethod
-    def _is_init_line_inclusive(line, state):
-        return line.startswith("```")
-
-    @staticmethod
-    def _is_term_line_inclusive(line, state):
-        return line.startswith("```")
+    INIT_RE = re.compile(r"```")
+    TERM_INCLUSIVE_RE = INIT_RE
 
 
 class MdBlockQuoteRegion(TextRegion):
@@ -39,38 +37,28 @@ class MdBlockQuoteRegion(TextRegion):
         super().__init__(lines)
         self.paragraph = Paragraph(l[3:] for l in self.lines)
 
-    @staticmethod
-    def _is_init_line_inclusive(line, state):
-        return line.startswith(" > ")
+    def get_paragraphs(self):
+        return [self.paragraph]
 
-    @staticmethod
-    def _is_term_line_exclusive(line, state):
-        return not line.startswith(" > ")
+    INIT_RE = re.compile(r" > ")
+    TERM_EXCLUSIVE_RE = re.compile(r"(?! > )")
 
-    def format_out(self, **kwargs):
+    def write_out(self, sink, **kwargs):
         # TODO: adjust fill with by 3 characters?
-        return [" > " + l for l in self.paragraph.format_out(**kwargs)]
+        sink.write([" > " + l for l in self.paragraph.format_out(**kwargs)])
 
 
 class MdParagraphRegion(ParagraphRegion):
     def __init__(self, lines: Iterable[str]):
         super().__init__(lines)
 
-    @staticmethod
-    def _is_term_line_exclusive(line, state):
-        return any(region_type.is_init_line(line, state)
-                   for region_type in MdDoc.get_region_types()
-                   if region_type != MdParagraphRegion)
+    TERM_ON_OTHER_INIT = True
 
 
 class MdBulletRegion(BulletRegion):
-    @staticmethod
-    def _is_init_line_inclusive(line, state):
-        return MdBulletRegion.split_bullet(line) is not None
-
-    @staticmethod
-    def _is_term_line_exclusive(line, state):
-        return len(line.strip()) == 0
+    # Lines that split_bullet accepts.
+    INIT_RE = re.compile(r" *[-+*] ?.")
+    TERM_EXCLUSIVE_RE = re.compile(r"\s*\Z")
 
     @staticmethod
     def split_bullet(line: str) -> Tuple[str, str]:
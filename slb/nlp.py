@@ -1,6 +1,105 @@
+import instrument
 import re
 
-from typing import Iterable
+from typing import Dict, Iterable, List, Sequence
+
+
+class TokenTable:
+    # Tokens of a paragraph as their lengths and their widths including the
+    # whitespace after them, for the allocators. Lines of tokens are sliced
+    # from the text at starts, or joined with spaces when the table only
+    # has the token strings. Tables are built per paragraph as it is
+    # allocated, holding them for a whole doc costs more in GC than it saves.
+    # Columns are lists, or NumPy arrays with arrays set, for the allocators
+    # that take them, see Allocator.array_columns.
+    def __init__(self, text: str, starts: Sequence[int], lens: Sequence[int],
+                 widths: Sequence[int], tokens: List[str] = None):
+        self.text = text
+        self.starts = starts
+        self.lens = lens
+        self.widths = widths
+        self.tokens = tokens
+
+    @classmethod
+    def from_tokens(cls, tokens: List[str], arrays: bool = False) -> "TokenTable":
+        # Every column is filled by a builtin, without a Python step per
+        # token. Small ints are shared, so the columns hold no new objects.
+        if arrays:
+            import numpy
+            lens = numpy.fromiter(map(len, tokens), dtype=numpy.int64, count=len(tokens))
+            return cls(None, None, lens, lens + 1, tokens)
+        lens = list(map(len, tokens))
+        return cls(None, None, lens, list(map((1).__add__, lens)), tokens)
+
+    @classmethod
+    def from_columns(cls, text: str, starts, lens, widths,
+                     arrays: bool = False) -> "TokenTable":
+        if arrays:
+            import numpy
+            return cls(text, numpy.asarray(starts, dtype=numpy.int64),
+                       numpy.asarray(lens, dtype=numpy.int64),
+                       numpy.asarray(widths, dtype=numpy.int64))
+        return cls(text, starts, lens, widths)
+
+    def __len__(self):
+        return len(self.lens)
+
+    def lines(self, bounds: List[int]) -> List[str]:
+        # The lines between consecutive bounds of allocate_bounds.
+        if self.starts is None:
+            tokens = self.tokens
+            return [" ".join(tokens[a:b]) for a, b in zip(bounds, bounds[1:])]
+        text = self.text
+        starts = self.starts
+        lens = self.lens
+        return [text[starts[a]: starts[b - 1] + lens[b - 1]] if b > a else ""
+                for a, b in zip(bounds, bounds[1:])]
+
+
+class Parse:
+    # What allocation needs of a paragraph, none of which depends on the fill
+    # width: its token table and break tags. Parses are kept by ParseCache so
+    # that reflowing to another width only allocates again.
+    def __init__(self, table: TokenTable, break_at: List[bool], illegal_at: List[bool]):
+        self.table = table
+        self.break_at = break_at
+        self.illegal_at = illegal_at
+
+    @classmethod
+    def from_doc(cls, doc, **kwargs) -> "Parse":
+        tokenizer = kwargs.get("tokenizer", Tokenizer)
+        allocator = kwargs.get("allocator", Allocator)
+        table = tokenizer.token_table(doc, allocator.array_columns(len(doc)))
+        if "token_wlen_f" in kwargs:
+            # Such parses aren't cached, see Doc._get_parse_cache.
+            table.widths = [kwargs["token_wlen_f"](token) for token in doc]
+        return cls(table,
+                   list(allocator.tag_desired_breaks(doc, **kwargs)),
+                   list(allocator.tag_illegal_breaks(doc, **kwargs)))
+
+    def to_dict(self) -> dict:
+        table = self.table
+        if table.starts is None:
+            return {"tokens": table.tokens,
+                    "break_at": self.break_at, "illegal_at": self.illegal_at}
+        return {"text": table.text, "starts": _to_list(table.starts),
+                "lens": _to_list(table.lens), "widths": _to_list(table.widths),
+                "break_at": self.break_at, "illegal_at": self.illegal_at}
+
+    @classmethod
+    def from_dict(cls, d: dict, **kwargs) -> "Parse":
+        allocator = kwargs.get("allocator", Allocator)
+        arrays = allocator.array_columns(len(d["break_at"]))
+        if "tokens" in d:
+            table = TokenTable.from_tokens(d["tokens"], arrays)
+        else:
+            table = TokenTable.from_columns(d["text"], d["starts"], d["lens"], d["widths"],
+                                            arrays)
+        return cls(table, d["break_at"], d["illegal_at"])
+
+
+def _to_list(column) -> list:
+    return column if isinstance(column, list) else column.tolist()
 
 
 class Tokenizer:
@@ -8,6 +107,26 @@ class Tokenizer:
     def tokenize(cls, text: str, **kwargs) -> Iterable:
         return re.split(r"\s+", text)
 
+    @classmethod
+    def tokenize_all(cls, texts: List[str], **kwargs) -> List:
+        return [cls.tokenize(text, **kwargs) for text in texts]
+
+    @classmethod
+    def warm_up(cls):
+        pass
+
+    @classmethod
+    def unload(cls):
+        pass
+
+    @staticmethod
+    def model_id() -> str:
+        return None
+
+    @staticmethod
+    def token_table(doc, arrays: bool = False) -> TokenTable:
+        return TokenTable.from_tokens(doc, arrays)
+
     @staticmethod
     def join_tokens(tokens: Iterable) -> str:
         return " ".join(tokens)
@@ -19,71 +138,350 @@ class Tokenizer:
 
 class Allocator:
     @staticmethod
+    @instrument.timed("tag_breaks")
     def tag_desired_breaks(doc, **kwargs):
         return [False] * len(doc)
 
     @staticmethod
+    @instrument.timed("tag_breaks")
     def tag_illegal_breaks(doc, **kwargs):
         return [False] * len(doc)
 
     @staticmethod
-    def _total_token_lens(doc, illegal_at):
-        lens = [0] * len(doc)
+    def _total_token_lens(lens, illegal_at):
+        totals = [0] * len(lens)
         commitment = 0
-        for i in range(len(doc) - 1, -1, -1):
-            t_len = len(doc[i])
-            commitment += t_len
-            lens[i] = commitment
+        for i in range(len(lens) - 1, -1, -1):
+            commitment += lens[i]
+            totals[i] = commitment
             if not illegal_at[i]:
                 commitment = 0
-        return lens
+        return totals
 
     @classmethod
     def allocate(cls, doc, wlen_f, **kwargs):
+        if wlen_f is Tokenizer.token_len_with_whitespace:
+            table = TokenTable.from_tokens(doc, cls.array_columns(len(doc)))
+            bounds = cls.allocate_bounds(doc, table.lens, table.widths, **kwargs)
+        else:
+            bounds = cls.allocate_bounds(doc, [len(token) for token in doc],
+                                         [wlen_f(token) for token in doc], **kwargs)
+        return [list(doc[a:b]) for a, b in zip(bounds, bounds[1:])]
+
+    @classmethod
+    def allocate_bounds(cls, doc, lens, widths, **kwargs) -> List[int]:
+        # Token indices where lines start, ending with the token count when
+        # the last line isn't empty. A repeated index is an empty line.
         fill_width = kwargs.get("fill_width", 80)
         break_at = cls.tag_desired_breaks(doc, **kwargs)
         illegal_at = cls.tag_illegal_breaks(doc, **kwargs)
-        commitments = cls._total_token_lens(doc, illegal_at)
-        lines = []
-        line = []
+        return cls._allocate_bounds(lens, widths, break_at, illegal_at, fill_width)
+
+    @classmethod
+    def allocate_parse(cls, parse: Parse, **kwargs) -> List[int]:
+        # allocate_bounds with the tags of a cached parse. Parses are shared
+        # by allocators with the same taggers, so the columns may have been
+        # built for another one.
+        lens = parse.table.lens
+        widths = parse.table.widths
+        if not cls.array_columns(len(lens)):
+            lens = _to_list(lens)
+            widths = _to_list(widths)
+        return cls._allocate_bounds(lens, widths, parse.break_at, parse.illegal_at,
+                                    kwargs.get("fill_width", 80))
+
+    @classmethod
+    def allocate_widths(cls, parse: Parse, fill_widths: Iterable[int]) -> Dict[int, List[int]]:
+        # allocate_parse at every fill width, with what doesn't depend on the
+        # width computed once for all of them.
+        lens = parse.table.lens
+        widths = parse.table.widths
+        if not cls.array_columns(len(lens)):
+            lens = _to_list(lens)
+            widths = _to_list(widths)
+        return cls._allocate_widths(lens, widths, parse.break_at, parse.illegal_at,
+                                    list(dict.fromkeys(fill_widths)))
+
+    @classmethod
+    def array_columns(cls, n: int) -> bool:
+        # Whether _allocate_bounds takes the columns of n tokens as NumPy
+        # arrays rather than lists.
+        return False
+
+    @classmethod
+    def tagger_id(cls) -> str:
+        # Allocators sharing both break taggers tag a doc the same way.
+        return " ".join("{}.{}".format(f.__module__, f.__qualname__)
+                        for f in (cls.tag_desired_breaks, cls.tag_illegal_breaks))
+
+    @classmethod
+    def _allocate_bounds(cls, lens, widths, break_at, illegal_at, fill_width):
+        return cls._allocate_widths(lens, widths, break_at, illegal_at, [fill_width])[fill_width]
+
+    @classmethod
+    def _allocate_widths(cls, lens, widths, break_at, illegal_at, fill_widths):
+        # Bounds at each fill width. Commitments don't depend on the width.
+        commitments = cls._total_token_lens(lens, illegal_at)
+        return {fill_width: cls._fill_bounds(lens, widths, break_at, illegal_at, commitments,
+                                             fill_width)
+                for fill_width in fill_widths}
+
+    @staticmethod
+    def _fill_bounds(lens, widths, break_at, illegal_at, commitments, fill_width):
+        n = len(lens)
+        bounds = [0]
         line_len = 0
         i = 0
-        while i < len(doc):
-            commitment = commitments[i]
-            if (line_len + commitment > fill_width or break_at[i]) and not illegal_at[i]:
-                lines.append(line)
-                line = []
+        while i < n:
+            if (line_len + commitments[i] > fill_width or break_at[i]) and not illegal_at[i]:
+                bounds.append(i)
                 line_len = 0
                 append_token = True
-                while i < len(doc) and append_token:
-                    line.append(doc[i])
-                    line_len += wlen_f(doc[i])
-                    append_token = illegal_at[i + 1] if i < len(doc) - 1 else False
+                while i < n and append_token:
+                    line_len += widths[i]
+                    append_token = illegal_at[i + 1] if i < n - 1 else False
                     i += 1
             else:
-                line_len += wlen_f(doc[i])
-                line.append(doc[i])
+                line_len += widths[i]
                 i += 1
+        if bounds[-1] < n:
+            bounds.append(n)
+        return bounds
 
-        if line:
-            lines.append(line)
-        return lines
 
+class OptimalAllocator(Allocator):
+    # Costs are in units where an empty line of slack costs SLACK_WEIGHT.
+    SLACK_WEIGHT = 100
+    UNDESIRED_BREAK_PENALTY = 10
+    MISSED_BREAK_PENALTY = 1000
+    OVERFULL_PENALTY = 100000
 
-class Spacy(Tokenizer, Allocator):
-    NLP = None
+    @classmethod
+    def _allocate_bounds(cls, lens, widths, break_at, illegal_at, fill_width):
+        # Shortest path over legal break positions. A line only extends while
+        # it fits (plus the one unbreakable unit that may overflow), so each
+        # position looks at a bounded window and the whole pass is O(n * W).
+        n = len(lens)
+        if n == 0:
+            return [0]
+        inf = float("inf")
+        best = [inf] * (n + 1)
+        prev = [0] * (n + 1)
+        best[0] = 0
+        for a in range(n):
+            if best[a] == inf or (a > 0 and illegal_at[a]):
+                continue
+            line_width = 0
+            missed = 0
+            for b in range(a + 1, n + 1):
+                line_width += widths[b - 1]
+                visible = line_width - widths[b - 1] + lens[b - 1]
+                if b > a + 1 and break_at[b - 1] and not illegal_at[b - 1]:
+                    missed += 1
+                if b < n and illegal_at[b]:
+                    continue
+                slack = fill_width - visible
+                if slack < 0:
+                    cost = cls.OVERFULL_PENALTY * -slack
+                elif b == n or break_at[b]:
+                    cost = 0
+                else:
+                    cost = cls.SLACK_WEIGHT * slack * slack / (fill_width * fill_width) \
+                        + cls.UNDESIRED_BREAK_PENALTY
+                cost += best[a] + missed * cls.MISSED_BREAK_PENALTY
+                if cost < best[b]:
+                    best[b] = cost
+                    prev[b] = a
+                if slack < 0:
+                    break
+        bounds = [n]
+        while bounds[-1] > 0:
+            bounds.append(prev[bounds[-1]])
+        return bounds[::-1]
+
+    @classmethod
+    def _allocate_widths(cls, lens, widths, break_at, illegal_at, fill_widths):
+        # The window of every position depends on the width, so there is
+        # nothing to share between widths but the parse.
+        return {fill_width: cls._allocate_bounds(lens, widths, break_at, illegal_at, fill_width)
+                for fill_width in fill_widths}
+
+
+class NumpyAllocator(Allocator):
+    # Same breaks as Allocator.allocate, with prefix sums and commitments
+    # computed as arrays instead of a Python step per token.
+    # Below this many tokens setting up the arrays costs more than the
+    # Python loop saves.
+    MIN_TOKENS = 512
+
+    @classmethod
+    def array_columns(cls, n):
+        return n >= cls.MIN_TOKENS
+
+    @classmethod
+    def _allocate_widths(cls, lens, widths, break_at, illegal_at, fill_widths):
+        import numpy
+        if not cls.array_columns(len(lens)):
+            return super()._allocate_widths(_to_list(lens), _to_list(widths), break_at,
+                                            illegal_at, fill_widths)
+        return cls._greedy_bounds(numpy.asarray(lens, dtype=numpy.int64),
+                                  numpy.asarray(widths, dtype=numpy.int64),
+                                  cls._flags(break_at), cls._flags(illegal_at), fill_widths)
 
     @staticmethod
-    def _get_nlp():
-        import en_core_web_md
-        if Spacy.NLP is None:
-            Spacy.NLP = en_core_web_md.load()
-        return Spacy.NLP
+    def _flags(flags):
+        # Tags are lists of bools, which as bytes are already a bool array,
+        # several times faster than converting them one by one.
+        import numpy
+        if isinstance(flags, numpy.ndarray):
+            return flags.astype(bool, copy=False)
+        return numpy.frombuffer(bytes(flags), dtype=bool)
+
+    @staticmethod
+    def _greedy_bounds(lens, widths, break_at, illegal_at, fill_widths):
+        # Tokens joined by illegal breaks are always placed together, so the
+        # breaks are found over those runs as units and mapped back to tokens.
+        import numpy
+        n = len(lens)
+        if n == 0:
+            return {fill_width: [0] for fill_width in fill_widths}
+        line_lens = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(widths, out=line_lens[1:])
+        if not illegal_at.any():
+            return NumpyAllocator._unit_bounds(line_lens, lens, break_at, True, fill_widths)
+        starts = numpy.flatnonzero(~illegal_at)
+        if illegal_at[0]:
+            starts = numpy.concatenate(([0], starts))
+        bound = numpy.append(starts, n)
+        token_lens = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(lens, out=token_lens[1:])
+        allocated = NumpyAllocator._unit_bounds(line_lens[bound], numpy.diff(token_lens[bound]),
+                                                break_at[starts], not illegal_at[0], fill_widths)
+        return {fill_width: bound[bounds].tolist() for fill_width, bounds in allocated.items()}
+
+    @staticmethod
+    def _unit_bounds(line_lens, lens, break_at, can_break_first, fill_widths):
+        # line_lens[u] is the width of the units before u. A line starting at
+        # u takes it and then the following units while they fit and none is
+        # a desired break. That only depends on u, so the end of a line is
+        # computed for every start at once and the lines are then found by
+        # following those links.
+        import numpy
+        n = len(lens)
+        # Line length up to the end of each unit, which is where it is
+        # measured against a line's limit. Widths include the whitespace
+        # after a unit, so this only grows and the first unit past a limit
+        # is a binary search. Other widths are scanned for after. None of
+        # this depends on the fill width, only the limits below do.
+        reach = line_lens[:n] + lens
+        reach_max = numpy.maximum.accumulate(reach)
+        first = numpy.arange(1, n + 1)
+        desired = numpy.flatnonzero(break_at)
+        next_desired = None
+        if len(desired):
+            next_desired = numpy.full(n + 1, n, dtype=numpy.int64)
+            next_desired[desired] = desired
+            next_desired = numpy.minimum.accumulate(next_desired[::-1])[::-1][1:]
+        allocated = dict()
+        for fill_width in fill_widths:
+            allocated[fill_width] = NumpyAllocator._fill_units(
+                reach, reach_max, line_lens[:n] + fill_width, first, next_desired, break_at,
+                can_break_first, fill_width)
+        return allocated
+
+    @staticmethod
+    def _fill_units(reach, reach_max, limits, first, next_desired, break_at, can_break_first,
+                    fill_width):
+        # The lines at one fill width, limits[u] is how far a line starting
+        # at unit u may reach.
+        import numpy
+        n = len(reach)
+        ends = numpy.searchsorted(reach_max, limits, side="right")
+        numpy.maximum(ends, first, out=ends)
+        if next_desired is not None:
+            numpy.minimum(ends, next_desired, out=ends)
+        for u in numpy.flatnonzero(reach_max > limits).tolist():
+            j = u + 1
+            while j < n and reach[j] <= limits[u] and not break_at[j]:
+                j += 1
+            ends[u] = j
+
+        bounds = [0]
+        if can_break_first and (break_at[0] or reach[0] > fill_width):
+            # The first line is empty.
+            bounds.append(0)
+        j = int(ends[0])
+        while j < n:
+            bounds.append(j)
+            j = int(ends[j])
+        if bounds[-1] < n:
+            bounds.append(n)
+        return bounds
+
+
+class Spacy(Tokenizer, Allocator):
+    # Pipelines are shared by every class loading the same model.
+    MODEL = "en_core_web_md"
+    EXCLUDE = ()
+    PIPELINES = dict()
+    MODEL_IDS = dict()
+
+    @classmethod
+    def _load(cls):
+        import importlib
+        return importlib.import_module(cls.MODEL).load(exclude=list(cls.EXCLUDE))
+
+    @classmethod
+    def _get_nlp(cls):
+        if cls.MODEL not in Spacy.PIPELINES:
+            Spacy.PIPELINES[cls.MODEL] = cls._load()
+        return Spacy.PIPELINES[cls.MODEL]
+
+    @classmethod
+    def warm_up(cls):
+        cls._get_nlp()
+
+    @classmethod
+    def unload(cls):
+        Spacy.PIPELINES.pop(cls.MODEL, None)
+        Spacy.MODEL_IDS.pop(cls.MODEL, None)
+
+    @classmethod
+    def _model_version(cls):
+        import importlib.metadata
+        return importlib.metadata.version(cls.MODEL)
+
+    @classmethod
+    def model_id(cls):
+        if cls.MODEL not in Spacy.MODEL_IDS:
+            Spacy.MODEL_IDS[cls.MODEL] = "{}-{}".format(cls.MODEL, cls._model_version())
+        return Spacy.MODEL_IDS[cls.MODEL]
 
     @classmethod
     def tokenize(cls, text, **kwargs):
+        instrument.count("model_calls")
+        instrument.count("model_texts")
         return cls._get_nlp()(text)
 
+    @classmethod
+    def tokenize_all(cls, texts, **kwargs):
+        batch_size = kwargs.get("batch_size", 64)
+        instrument.count("model_calls")
+        instrument.count("model_texts", len(texts))
+        return list(cls._get_nlp().pipe(texts, batch_size=batch_size))
+
+    @staticmethod
+    def token_table(doc, arrays: bool = False) -> TokenTable:
+        from spacy.attrs import IDX, LENGTH, SPACY
+        features = doc.to_array([IDX, LENGTH, SPACY])
+        if arrays:
+            features = features.astype("int64")
+            lens = features[:, 1]
+            return TokenTable(doc.text, features[:, 0], lens, lens + features[:, 2])
+        lens = features[:, 1]
+        return TokenTable(doc.text, features[:, 0].tolist(), lens.tolist(),
+                          (lens + features[:, 2]).tolist())
+
     @staticmethod
     def join_tokens(tokens):
         if not tokens:
@@ -96,27 +494,115 @@ class Spacy(Tokenizer, Allocator):
         return len(token.text_with_ws)
 
     @staticmethod
+    @instrument.timed("tag_breaks")
     def tag_desired_breaks(doc, **kwargs):
+        import numpy
+        from spacy.attrs import HEAD, POS, TAG
+        from spacy.symbols import VERB
         doc_len = len(doc)
         break_at = [False] * doc_len
+        if doc_len == 0:
+            return break_at
+        # Pipelines without a tagger or parser leave those features unset,
+        # then only the sentence breaks are tagged.
+        features = doc.to_array([HEAD, TAG, POS])
+        has_deps = doc.has_annotation("DEP")
+        # HEAD comes back as an unsigned offset from each token to its head.
+        heads = numpy.arange(doc_len) + features[:, 0].astype(numpy.int64)
+        is_cc = (features[:, 1] == doc.vocab.strings["CC"]) & (features[:, 2][heads] == VERB)
+        cc_before = numpy.concatenate(([0], numpy.cumsum(is_cc)))
+        for i in numpy.flatnonzero(is_cc).tolist():
+            break_at[i] = True
+
+        sizes = None
         for sent in doc.sents:
             if sent.end < doc_len:
                 break_at[sent.end] = True
-            for token in sent:
-                if token.tag_ == "CC" and token.head.pos_ == "VERB":
-                    break_at[token.i] = True
-
-            has_break = any(break_at[i] for i in range(sent.start, sent.end))
-            if len(sent) > 8 and not has_break:
-                for t in sent:
-                    if len(list(t.subtree)) > 4 and len(list(t.head.children)) == 2:
-                        break_at[t.i] = True
+            # Earlier sentences only ever mark this sentence's first token.
+            has_break = break_at[sent.start] or cc_before[sent.end] > cc_before[sent.start]
+            if len(sent) > 8 and not has_break and has_deps:
+                if sizes is None:
+                    sizes, child_counts = Spacy._subtree_sizes(heads)
+                subtree = sizes[sent.start: sent.end] > 4
+                two_children = child_counts[heads[sent.start: sent.end]] == 2
+                for i in numpy.flatnonzero(subtree & two_children).tolist():
+                    break_at[sent.start + i] = True
         return break_at
 
     @staticmethod
+    def _subtree_sizes(heads):
+        # Sizes are added up from the leaves, a token is passed to its head
+        # once all of its children are done.
+        import numpy
+        doc_len = len(heads)
+        is_child = heads != numpy.arange(doc_len)
+        child_counts = numpy.bincount(heads[is_child], minlength=doc_len)
+        pending = child_counts.tolist()
+        head_list = heads.tolist()
+        sizes = [1] * doc_len
+        ready = [i for i in range(doc_len) if pending[i] == 0]
+        while ready:
+            i = ready.pop()
+            head = head_list[i]
+            if head != i:
+                sizes[head] += sizes[i]
+                pending[head] -= 1
+                if pending[head] == 0:
+                    ready.append(head)
+        return numpy.array(sizes), child_counts
+
+    @staticmethod
+    @instrument.timed("tag_breaks")
     def tag_illegal_breaks(doc, **kwargs):
         illegal = [False] * len(doc)
         for token in doc[:-1]:
             if not token.whitespace_:
                 illegal[token.i + 1] = True
         return illegal
+
+
+
+class SpacySmall(Spacy):
+    # The break tagger reads tags, heads and sentences only.
+    MODEL = "en_core_web_sm"
+    EXCLUDE = ("ner", "lemmatizer")
+
+
+class SpacySentences(Spacy):
+    # Rule-based sentence boundaries, no statistical model.
+    MODEL = "sentencizer"
+
+    @classmethod
+    def _load(cls):
+        import spacy
+        nlp = spacy.blank("en")
+        nlp.add_pipe("sentencizer")
+        return nlp
+
+    @classmethod
+    def _model_version(cls):
+        import spacy
+        return "spacy-{}".format(spacy.__version__)
+
+
+class SpacyOptimal(OptimalAllocator, Spacy):
+    pass
+
+
+class SpacyNumpy(NumpyAllocator, Spacy):
+    pass
+
+
+# Tiers from fastest to most accurate. The small model and the sentencizer
+# share the Spacy break tagger, which uses whatever features the doc has.
+NLP_BACKENDS = {"regex": (Tokenizer, Allocator),
+                "sentences": (SpacySentences, Spacy),
+                "small": (SpacySmall, Spacy),
+                "spacy": (Spacy, Spacy)}
+
+LINE_BREAKERS = {"greedy": {Allocator: Allocator,
+                            Spacy: Spacy},
+                 "numpy": {Allocator: NumpyAllocator,
+                           Spacy: SpacyNumpy},
+                 "optimal": {Allocator: OptimalAllocator,
+                             Spacy: SpacyOptimal}}
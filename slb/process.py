@@ -1,68 +1,98 @@
-import re
 import itertools
+import re
+import instrument
 import nlp
 
-from util import TextSource, RegionSource, FileTextSource
+from util import TextSource, FileTextSource, MappedTextSource, LineSpans
 from typing import Iterable, Dict, List, Tuple
 
 
-class TextRegion:
-    def __init__(self, lines: Iterable[str]):
-        self.lines = list(lines)
+class LineSink:
+    # Output lines of a doc, written by its regions in order into one list
+    # sized for the input. Lines written inside list items get the item's
+    # bullet on their first line and its indentation on the rest, where
+    # blank lines are dropped. Items nest, the innermost applies first.
+    def __init__(self, size: int = 0):
+        self.lines = [None] * size
+        self.n = 0
+        self.items = []
+        self.indent = ""
+        self.pending = 0
+
+    def push(self, bullet: str, indent: int):
+        self.items.append([bullet, " " * indent])
+        self.indent += " " * indent
+        self.pending += 1
+
+    def pop(self):
+        bullet, indent = self.items.pop()
+        self.indent = self.indent[:len(self.indent) - len(indent)]
+        if bullet is not None:
+            # The item wrote no lines, its bullet is dropped.
+            self.pending -= 1
+
+    def write(self, lines: Iterable[str]):
+        if not isinstance(lines, (list, LineSpans)):
+            lines = list(lines)
+        if self.pending:
+            i = 0
+            while self.pending and i < len(lines):
+                self._write_first(lines[i])
+                i += 1
+            lines = lines[i:]
+        if self.items:
+            indent = self.indent
+            lines = [indent + line for line in lines if line.strip()]
+        n = self.n
+        self.lines[n: n + len(lines)] = lines
+        self.n = n + len(lines)
+
+    def _write_first(self, line: str):
+        # A line while some item hasn't written its first line yet.
+        for item in reversed(self.items):
+            if item[0] is not None:
+                line = item[0] + line
+                item[0] = None
+                self.pending -= 1
+            elif not line.strip():
+                return
+            else:
+                line = item[1] + line
+        self.lines[self.n: self.n + 1] = [line]
+        self.n += 1
 
-    def format_out(self, **kwargs) -> Iterable[str]:
+    def getvalue(self) -> List[str]:
+        del self.lines[self.n:]
         return self.lines
 
-    @classmethod
-    def is_init_line(cls, line: str, state: Dict):
-        init = False
-        if cls._is_init_line_inclusive(line, state):
-            init = True
-        if init:
-            cls._set_state(state, "just_init", True)
-        return init
 
-    @staticmethod
-    def _is_init_line_inclusive(line: str, state: Dict):
-        return True
+class TextRegion:
+    def __init__(self, lines: Iterable[str]):
+        self.lines = lines if isinstance(lines, LineSpans) else list(lines)
 
-    @classmethod
-    def is_term_line(cls, line: str, state: Dict):
-        if cls._get_state(state, "just_init"):
-            cls._set_state(state, "just_init", False)
-            return False
-        elif cls._get_state(state, "end_next"):
-            cls._set_state(state, "end_next", False)
-            return True
-        if cls._is_term_line_exclusive(line, state):
-            return True
-        elif cls._is_term_line_inclusive(line, state):
-            cls._set_state(state, "end_next", True)
-            return False
+    def format_out(self, **kwargs) -> List[str]:
+        sink = LineSink(len(self.lines))
+        self.write_out(sink, **kwargs)
+        return sink.getvalue()
 
-    @staticmethod
-    def _is_term_line_inclusive(line: str, state: Dict):
-        return False
+    def write_out(self, sink: LineSink, **kwargs):
+        sink.write(self.lines)
 
-    @staticmethod
-    def _is_term_line_exclusive(line: str, state: Dict):
-        return False
+    def get_paragraphs(self) -> Iterable["Paragraph"]:
+        return []
 
-    @classmethod
-    def from_source(cls, source: TextSource, state: Dict):
-        region_source = RegionSource(source, lambda l: cls.is_term_line(l, state))
-        lines = list(region_source)
-        return cls(lines)
+    # Region detection, see RegionScanner. The patterns are matched at the
+    # start of a line and a region type without INIT_RE starts on any line.
+    # A line matching TERM_EXCLUSIVE_RE starts the next region, one matching
+    # TERM_INCLUSIVE_RE is the last line of this one. Regions that
+    # TERM_ON_OTHER_INIT end where any other region type could start.
+    INIT_RE = None
+    TERM_EXCLUSIVE_RE = None
+    TERM_INCLUSIVE_RE = None
+    TERM_ON_OTHER_INIT = False
 
-    @classmethod
-    def _get_state(cls, state, key):
-        key = "{}_{}".format(cls.__name__, key)
-        return state[key] if key in state else None
 
-    @classmethod
-    def _set_state(cls, state, key, val):
-        key = "{}_{}".format(cls.__name__, key)
-        state[key] = val
+SEPARATOR = [""]
 
 
 class ParagraphRegion(TextRegion):
@@ -70,62 +100,86 @@ class ParagraphRegion(TextRegion):
         super().__init__(lines)
         self.paragraphs = list(Paragraph.from_lines(self.lines))
 
-    def format_out(self, **kwargs):
-        return self._separate_paragraphs(p.format_out(**kwargs) for p in self.paragraphs)
+    def write_out(self, sink, **kwargs):
+        for i, paragraph in enumerate(self.paragraphs):
+            if i > 0:
+                sink.write(SEPARATOR)
+            sink.write(paragraph.format_out(**kwargs))
 
-    @staticmethod
-    def _separate_paragraphs(paragraphs: Iterable[Iterable[str]]):
-        first_paragraph = True
-        for paragraph in paragraphs:
-            if first_paragraph:
-                first_paragraph = False
-            else:
-                yield ""
-            for line in paragraph:
-                yield line
+    def get_paragraphs(self):
+        return self.paragraphs
 
 
 class BulletRegion(TextRegion):
+    # A list with its nested lists, parsed into a flat run of operations on
+    # a LineSink: the lines of the list's other regions, separators, list
+    # prefixes and suffixes, and item starts and ends. Item bodies are read
+    # as docs of get_doc_class(), with an explicit stack of the lists and
+    # bodies being read instead of a nested Doc per item.
+    LINES, REGION, PUSH, POP, LIST, BODY = range(6)
+
     def __init__(self, lines: Iterable[str]):
         super().__init__(lines)
+        self.ops = []
+        stack = [iter(self._split_items(FileTextSource(iter(self.lines))))]
+        while stack:
+            op = next(stack[-1], None)
+            if op is None:
+                stack.pop()
+            elif op[0] == self.LIST:
+                stack.append(iter(op[1]._split_items(FileTextSource(iter(op[2])))))
+            elif op[0] == self.BODY:
+                stack.append(self._scan_body(op[1], op[2]))
+            else:
+                self.ops.append(op)
 
-        src = FileTextSource(l for l in lines)
-        self.prefix = self.get_prefix(src)
-        self.suffix = []
-        self.bullets = []
-        bullets = []
+    @classmethod
+    def _split_items(cls, src: TextSource) -> List[Tuple]:
+        # This list's own lines, item bodies are left for the caller.
+        ops = []
+        prefix = cls.get_prefix(src)
+        if prefix:
+            ops.append((cls.LINES, prefix))
+        suffix = []
         bullet = None
         blines = []
+        for line in src:
+            if bullet is not None and cls.is_continuation(line, bullet):
+                blines.append(cls.split_continuation(line, bullet))
+                continue
+            split = cls.split_bullet(line)
+            if split is not None:
+                if bullet is not None:
+                    ops.extend(cls._item_ops(bullet, blines))
+                bullet, first_line = split
+                blines = [first_line]
+            elif cls.get_suffix(line) is not None:
+                suffix = [line]
+            else:
+                raise ValueError("unexpected line in list: {!r}".format(line))
+        if bullet is not None:
+            ops.extend(cls._item_ops(bullet, blines))
+        if suffix:
+            ops.append((cls.LINES, suffix))
+        return ops
 
-        while True:
-            try:
-                line = next(src)
-                if bullet is None:
-                    bullet, first_line = self.split_bullet(line)
-                    blines = [first_line]
-                elif self.is_continuation(line, bullet):
-                    meat = self.split_continuation(line, bullet)
-                    blines.append(meat)
-                elif self.split_bullet(line) is not None:
-                    doc = self.get_doc_class().\
-                          from_source(FileTextSource(l for l in blines))
-                    bullets.append((bullet, doc))
-                    bullet, first_line = self.split_bullet(line)
-                    blines = [first_line]
-                elif self.get_suffix(line) is not None:
-                    self.suffix = [line]
-                else:
-                    print(line)
-                    raise ValueError()
-            except StopIteration:
-                break
+    @classmethod
+    def _item_ops(cls, bullet: str, blines: List[str]) -> List[Tuple]:
+        return [(cls.PUSH, bullet, cls.following_line_indent(bullet)),
+                (cls.BODY, cls.get_doc_class(), blines),
+                (cls.POP,)]
+
+    @classmethod
+    def _scan_body(cls, doc_class, blines: List[str]) -> Iterable[Tuple]:
+        for i, (region_type, lines) in enumerate(doc_class.get_scanner().scan(blines)):
+            instrument.count("regions." + region_type.__name__)
+            if i > 0:
+                yield cls.LINES, SEPARATOR
+            if issubclass(region_type, BulletRegion):
+                yield cls.LIST, region_type, lines
+            else:
+                yield cls.REGION, region_type(lines)
 
-        if bullet is not None:
-            doc = self.get_doc_class().\
-                  from_source(FileTextSource(l for l in blines))
-            bullets.append((bullet, doc))
-        self.bullets = bullets
-    
     @classmethod
     def is_continuation(cls, line: str, bullet: str) -> bool:
         indent = " " * cls.following_line_indent(bullet)
@@ -159,52 +213,168 @@ class BulletRegion(TextRegion):
         else:
             return None
 
-    def format_out(self, **kwargs):
-        fill_width = kwargs.get("fill_width", 80)
-
-        for l in self.prefix:
-            yield l
-        for bullet, doc in self.bullets:
-            indent = self.following_line_indent(bullet)
-            new_kwargs = kwargs.copy()
-            new_kwargs["fill_width"] = fill_width - indent
-            for line in doc.format_out(**kwargs):
-                if bullet is not None:
-                    yield bullet + line
-                    bullet = None
-                elif len(line.strip()) == 0:
-                    continue
-                else:
-                    yield " " * indent + line
-        for l in self.suffix:
-            yield l
+    def get_paragraphs(self):
+        for op in self.ops:
+            if op[0] == self.REGION:
+                yield from op[1].get_paragraphs()
+
+    def write_out(self, sink, **kwargs):
+        # Item bodies are formatted with their doc class's defaults for
+        # anything the caller didn't configure.
+        for key, value in self.get_doc_class()._get_default_format_config().items():
+            kwargs.setdefault(key, value)
+        for op in self.ops:
+            kind = op[0]
+            if kind == self.REGION:
+                op[1].write_out(sink, **kwargs)
+            elif kind == self.LINES:
+                sink.write(op[1])
+            elif kind == self.PUSH:
+                sink.push(op[1], op[2])
+            else:
+                sink.pop()
 
 
 class Doc:
+    SCANNERS = dict()
+
     def __init__(self, regions: Iterable[TextRegion]):
         self.regions = list(regions)
 
-    def format_out(self, **kwargs) -> Iterable[str]:
+    def format_out(self, **kwargs) -> List[str]:
+        kwargs = self.get_format_config(**kwargs)
+        if "parsed" not in kwargs:
+            self.parse_docs([(self, kwargs)])
+        sink = LineSink(sum(len(region.lines) for region in self.regions))
+        self.write_out(sink, **kwargs)
+        return sink.getvalue()
+
+    def write_out(self, sink: LineSink, **kwargs):
+        # Regions are separated by an empty line.
+        for i, region in enumerate(self.regions):
+            if i > 0:
+                sink.write(SEPARATOR)
+            region.write_out(sink, **kwargs)
+
+    def format_widths(self, widths: Iterable[int], **kwargs) -> Dict[int, List[str]]:
+        # The output at each fill width. Which paragraphs flow is decided
+        # once, each of those is tokenized and tagged once and the allocator
+        # breaks it at every width from that one parse. Only the lines of
+        # the regions are then written out once per width.
+        widths = list(widths)
+        kwargs = self.get_format_config(**kwargs)
+        can_flow = kwargs.get("can_flow")
+        paragraphs = [p for p in self.get_paragraphs() if can_flow is None or can_flow(p)]
+        flowable = frozenset(paragraphs)
+        formatted = {width: dict() for width in widths}
+        cache = kwargs.get("cache")
+        if cache is not None:
+            for width, lines in formatted.items():
+                lines.update(cache.get_many(paragraphs, **dict(kwargs, fill_width=width)))
+            paragraphs = [p for p in paragraphs
+                          if not all(p in formatted[width] for width in widths)]
+        allocator = kwargs.get("allocator", nlp.Allocator)
+        for paragraph, parse in self.parse_paragraphs(paragraphs, **kwargs).items():
+            started = instrument.start()
+            bounds = allocator.allocate_widths(parse, widths)
+            instrument.stop("allocate", started)
+            started = instrument.start()
+            for width in widths:
+                lines = parse.table.lines(bounds[width])
+                formatted[width][paragraph] = lines
+                if cache is not None:
+                    cache.put(paragraph.text, lines, **dict(kwargs, fill_width=width))
+            instrument.stop("join_tokens", started)
+        if can_flow is not None:
+            kwargs["can_flow"] = flowable.__contains__
+        outputs = dict()
+        for width in widths:
+            sink = LineSink(sum(len(region.lines) for region in self.regions))
+            self.write_out(sink, **dict(kwargs, fill_width=width, formatted=formatted[width],
+                                        parsed={}))
+            outputs[width] = sink.getvalue()
+        return outputs
+
+    def get_format_config(self, **kwargs) -> Dict:
         default_config = self._get_default_format_config()
         for key in default_config:
             if key not in kwargs:
                 kwargs[key] = default_config[key]
-        return self._separate_regions(r.format_out(**kwargs) for r in self.regions)
+        return kwargs
+
+    def get_paragraphs(self) -> Iterable["Paragraph"]:
+        for region in self.regions:
+            yield from region.get_paragraphs()
 
     @staticmethod
-    def _get_default_format_config():
-        return dict()
+    def parse_docs(jobs: List[Tuple["Doc", Dict]]):
+        # Parses the flowable paragraphs of several docs that share a tokenizer
+        # in one batch, storing the results under each job's "parsed" kwarg.
+        pending = []
+        for doc, kwargs in jobs:
+            can_flow = kwargs.get("can_flow", lambda l: True)
+            paragraphs = [p for p in doc.get_paragraphs() if can_flow(p)]
+            cache = kwargs.get("cache")
+            if cache is not None:
+                kwargs["formatted"] = cache.get_many(paragraphs, **kwargs)
+                paragraphs = [p for p in paragraphs if p not in kwargs["formatted"]]
+            kwargs["parsed"] = dict()
+            parse_cache = Doc._get_parse_cache(kwargs)
+            if parse_cache is not None and paragraphs:
+                kwargs["parsed"].update(parse_cache.get_many(paragraphs, **kwargs))
+                paragraphs = [p for p in paragraphs if p not in kwargs["parsed"]]
+            pending.extend((p, kwargs) for p in paragraphs)
+        if not pending:
+            return
+        tokenizer = jobs[0][1].get("tokenizer", nlp.Tokenizer)
+        texts = [p.text for p, kwargs in pending]
+        started = instrument.start()
+        docs = tokenizer.tokenize_all(texts, **jobs[0][1])
+        instrument.stop("tokenize", started)
+        for (paragraph, kwargs), doc in zip(pending, docs):
+            parse_cache = Doc._get_parse_cache(kwargs)
+            if parse_cache is not None:
+                # Tagged now, while the doc is at hand, and kept as a parse.
+                doc = nlp.Parse.from_doc(doc, **kwargs)
+                parse_cache.put(paragraph.text, doc, **kwargs)
+            kwargs["parsed"][paragraph] = doc
+        if instrument.ENABLED:
+            instrument.count("tokens", sum(len(doc) for doc in docs))
 
     @staticmethod
-    def _separate_regions(regions: Iterable[Iterable[str]]):
-        first_region = True
-        for region in regions:
-            if first_region:
-                first_region = False
-            else:
-                yield ""
-            for line in region:
-                yield line
+    def parse_paragraphs(paragraphs: List["Paragraph"], **kwargs) -> Dict["Paragraph", nlp.Parse]:
+        # Parses of paragraphs formatted with the same kwargs, from the parse
+        # cache or else tokenized in one batch.
+        parsed = dict()
+        parse_cache = Doc._get_parse_cache(kwargs)
+        if parse_cache is not None and paragraphs:
+            parsed.update(parse_cache.get_many(paragraphs, **kwargs))
+            paragraphs = [p for p in paragraphs if p not in parsed]
+        if not paragraphs:
+            return parsed
+        tokenizer = kwargs.get("tokenizer", nlp.Tokenizer)
+        started = instrument.start()
+        docs = tokenizer.tokenize_all([p.text for p in paragraphs], **kwargs)
+        instrument.stop("tokenize", started)
+        for paragraph, doc in zip(paragraphs, docs):
+            parse = nlp.Parse.from_doc(doc, **kwargs)
+            if parse_cache is not None:
+                parse_cache.put(paragraph.text, parse, **kwargs)
+            parsed[paragraph] = parse
+        if instrument.ENABLED:
+            instrument.count("tokens", sum(len(doc) for doc in docs))
+        return parsed
+
+    @staticmethod
+    def _get_parse_cache(kwargs: Dict):
+        # Cached parses have the tokenizer's token widths, not a custom one.
+        if "token_wlen_f" in kwargs:
+            return None
+        return kwargs.get("parse_cache")
+
+    @staticmethod
+    def _get_default_format_config():
+        return dict()
 
     @staticmethod
     def get_region_types():
@@ -212,22 +382,118 @@ class Doc:
 
     @classmethod
     def from_source(cls, source: TextSource):
-        region_types = cls.get_region_types()
-        regions = []
-        state = dict()
-        while source.has_next():
-            head = source.peek()
-            for region in region_types:
-                if region.is_init_line(head, state):
-                    regions.append(region.from_source(source, state))
-                    break
-        return cls(regions)
+        return cls(cls.iter_regions(source))
+
+    @classmethod
+    def format_regions(cls, source: TextSource, **kwargs) -> Iterable[List[str]]:
+        # Formats each region as soon as it is read, only one region and its
+        # output are held at a time. Regions are separated like format_out.
+        for region in cls.iter_regions(source):
+            yield list(cls([region]).format_out(**kwargs))
+
+    @classmethod
+    def get_scanner(cls) -> "RegionScanner":
+        if cls not in Doc.SCANNERS:
+            Doc.SCANNERS[cls] = RegionScanner(cls.get_region_types())
+        return Doc.SCANNERS[cls]
+
+    @classmethod
+    def iter_regions(cls, source: TextSource) -> Iterable[TextRegion]:
+        # Only time spent detecting and building regions is counted, not the
+        # consumer's time between regions.
+        started = instrument.start()
+        for region_type, lines in cls.get_scanner().scan(source):
+            region = region_type(lines)
+            instrument.stop("regions", started)
+            instrument.count("regions." + region_type.__name__)
+            yield region
+            started = instrument.start()
+        instrument.stop("regions", started)
+
+
+class RegionScanner:
+    # Compiles the init patterns of a doc's region types, in order of
+    # precedence, into one regex so that every line is classified once.
+    def __init__(self, region_types: Iterable[type]):
+        self.region_types = list(region_types)
+        self.fallback = None
+        self.named_types = dict()
+        patterns = []
+        for i, region_type in enumerate(self.region_types):
+            if region_type.INIT_RE is None:
+                # Starts on any line, so later types could never start.
+                self.fallback = region_type
+                break
+            name = "r{}".format(i)
+            self.named_types[name] = region_type
+            patterns.append("(?P<{}>{})".format(name, region_type.INIT_RE.pattern))
+        self.init_re = re.compile("|".join(patterns)) if patterns else None
+        self.terms = {region_type: self._compile_terms(region_type)
+                      for region_type in self.region_types}
+
+    def _compile_terms(self, region_type):
+        exclusive = None
+        if region_type.TERM_ON_OTHER_INIT:
+            exclusive = self.init_re.match if self.init_re is not None else None
+        elif region_type.TERM_EXCLUSIVE_RE is not None:
+            exclusive = region_type.TERM_EXCLUSIVE_RE.match
+        inclusive = None
+        if region_type.TERM_INCLUSIVE_RE is not None:
+            inclusive = region_type.TERM_INCLUSIVE_RE.match
+        return exclusive, inclusive
+
+    def classify(self, line: str) -> type:
+        m = self.init_re.match(line) if self.init_re is not None else None
+        if m is not None:
+            return self.named_types[m.lastgroup]
+        if self.fallback is None:
+            raise ValueError("no region starts at line {!r}".format(line))
+        return self.fallback
+
+    def scan(self, source: TextSource) -> Iterable[Tuple[type, List[str]]]:
+        # Regions of a MappedTextSource get spans of its lines, not copies.
+        spans = source.spans if isinstance(source, MappedTextSource) else None
+        base = source.index if spans is not None else 0
+        if spans is not None:
+            source = itertools.chain.from_iterable(source.blocks())
+        region_type = None
+        start = 0
+        lines = []
+        exclusive = inclusive = None
+        end_next = False
+        i = 0
+        for i, line in enumerate(source):
+            if region_type is not None:
+                if end_next or (exclusive is not None and exclusive(line)):
+                    yield region_type, spans(base + start, base + i) if spans else lines
+                    region_type = None
+                elif inclusive is not None and inclusive(line):
+                    end_next = True
+            if region_type is None:
+                region_type = self.classify(line)
+                exclusive, inclusive = self.terms[region_type]
+                start = i
+                lines = []
+                end_next = False
+            if spans is None:
+                lines.append(line)
+        if region_type is not None:
+            yield region_type, spans(base + start, base + i + 1) if spans else lines
 
 
 class Paragraph:
     def __init__(self, lines):
-        self.lines = list(lines)
-        self.text = self.join_read_lines(self.lines)
+        self.lines = lines if isinstance(lines, LineSpans) else list(lines)
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        # Joined on first use, mapped lines stay undecoded until then.
+        if self._text is None:
+            started = instrument.start()
+            self._text = self.join_read_lines(self.lines)
+            instrument.stop("join_read_lines", started)
+        return self._text
 
     def format_out(self, **kwargs):
         can_flow = kwargs.get("can_flow", lambda l: True)
@@ -235,18 +501,71 @@ class Paragraph:
             return self.lines
 
         tokenizer = kwargs.get("tokenizer", nlp.Tokenizer)
-        wlen_f = kwargs.get("token_wlen_f", tokenizer.token_len_with_whitespace)
         allocator = kwargs.get("allocator", nlp.Allocator)
 
-        tokens = tokenizer.tokenize(self.text, **kwargs)
-        token_lines = allocator.allocate(tokens, wlen_f, **kwargs)
-        return [tokenizer.join_tokens(token_line) for token_line in token_lines]
+        instrument.count("paragraphs")
+        formatted = kwargs.get("formatted", {}).get(self)
+        if formatted is not None:
+            return formatted
+
+        tokens = kwargs.get("parsed", {}).get(self)
+        if isinstance(tokens, nlp.Parse):
+            started = instrument.start()
+            bounds = allocator.allocate_parse(tokens, **kwargs)
+            instrument.stop("allocate", started)
+            started = instrument.start()
+            lines = tokens.table.lines(bounds)
+            instrument.stop("join_tokens", started)
+            return self._cache_lines(lines, **kwargs)
+        if tokens is None:
+            started = instrument.start()
+            tokens = tokenizer.tokenize(self.text, **kwargs)
+            instrument.stop("tokenize", started)
+            if instrument.ENABLED:
+                instrument.count("tokens", len(tokens))
+        started = instrument.start()
+        table = tokenizer.token_table(tokens, allocator.array_columns(len(tokens)))
+        widths = table.widths
+        if "token_wlen_f" in kwargs:
+            widths = [kwargs["token_wlen_f"](token) for token in tokens]
+        bounds = allocator.allocate_bounds(tokens, table.lens, widths, **kwargs)
+        instrument.stop("allocate", started)
+        # Lines are sliced from the paragraph text, not joined from tokens.
+        started = instrument.start()
+        lines = table.lines(bounds)
+        instrument.stop("join_tokens", started)
+        return self._cache_lines(lines, **kwargs)
+
+    def format_widths(self, widths: Iterable[int], **kwargs) -> Dict[int, List[str]]:
+        # Like Doc.format_widths, with one parse for every width.
+        widths = list(widths)
+        can_flow = kwargs.get("can_flow", lambda l: True)
+        if not can_flow(self):
+            return {width: self.lines for width in widths}
+        parse = kwargs.get("parsed", {}).get(self)
+        if parse is None:
+            parse = Doc.parse_paragraphs([self], **kwargs)[self]
+        elif not isinstance(parse, nlp.Parse):
+            parse = nlp.Parse.from_doc(parse, **kwargs)
+        allocator = kwargs.get("allocator", nlp.Allocator)
+        started = instrument.start()
+        bounds = allocator.allocate_widths(parse, widths)
+        instrument.stop("allocate", started)
+        return {width: self._cache_lines(parse.table.lines(bounds[width]),
+                                         **dict(kwargs, fill_width=width))
+                for width in widths}
+
+    def _cache_lines(self, lines: List[str], **kwargs) -> List[str]:
+        cache = kwargs.get("cache")
+        if cache is not None:
+            cache.put(self.text, lines, **kwargs)
+        return lines
 
     @staticmethod
     def join_read_lines(lines: Iterable) -> str:
         text = " ".join(lines)
         text = re.sub(r"\n", " ", text)
-        text = re.sub(r"(\s)\s*", r"\1", text)
+        text = re.sub(r"(\s)\s+", r"\1", text)
         return text
 
     @staticmethod
@@ -255,14 +574,17 @@ class Paragraph:
 
     @classmethod
     def from_lines(cls, lines):
-        current_paragraph = []
-        for line in lines:
-            if cls.is_paragraph_breaker(line):
-                if current_paragraph:
-                    yield cls(current_paragraph)
-                current_paragraph = []
-            else:
-                current_paragraph.append(line)
-        if current_paragraph:
-            yield cls(current_paragraph)
+        if isinstance(lines, LineSpans):
+            # Spans know their empty lines, the paragraph breakers.
+            breakers = lines.empty_lines()
+        else:
+            lines = list(lines)
+            breakers = [i for i, line in enumerate(lines) if cls.is_paragraph_breaker(line)]
+        start = 0
+        for i in breakers:
+            if i > start:
+                yield cls(lines[start:i])
+            start = i + 1
+        if len(lines) > start:
+            yield cls(lines[start:])
 
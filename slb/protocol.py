@@ -0,0 +1,147 @@
+import json
+import os
+import re
+import socket
+import struct
+import tempfile
+
+from util import MappedTextSource
+
+# Wire protocol of the daemon, apart from it so that clients don't load
+# asyncio or the formatting modules.
+PORT = 29010
+REQUEST_HEADER_FMT = "L"
+RESPONSE_HEADER_FMT = "L"
+REQUEST_HEADER_SIZE = struct.calcsize(REQUEST_HEADER_FMT)
+
+# Framed protocol. Every frame starts with FRAME_MAGIC, which read as a legacy
+# native "L" length would be an impossibly large body, so both protocols can
+# share a port. The header that follows is network byte order:
+# version, kind, request id, options length, body length.
+# Options are a JSON object, the body is the UTF-8 document.
+# OPEN keeps a parsed document in the daemon and answers with its "doc_id",
+# EDIT takes "doc_id", "start" and "end" options plus the replacement text of
+# those source lines and answers with a JSON patch of the formatted output.
+# STATS answers with the daemon's cumulative instrumentation as JSON.
+# Over the Unix socket a FORMAT body can instead be a file in SHM_DIR named by
+# the "shm" option, which the daemon maps and removes. The response to such a
+# request is passed the same way when it is large, with the file named by the
+# "shm" option of the response, for the client to read and remove.
+FRAME_MAGIC = b"SLBFRAME"
+FRAME_VERSION = 2
+FRAME_HEADER_FMT = "!BBIII"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FMT)
+KIND_FORMAT = 1
+KIND_RESPONSE = 2
+KIND_ERROR = 3
+KIND_OPEN = 4
+KIND_EDIT = 5
+KIND_CLOSE = 6
+KIND_STATS = 7
+
+# Bodies smaller than this are cheaper to send over the socket.
+SHM_MIN_BYTES = 256 * 1024
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHM_NAME_RE = re.compile(r"slb-\w+\Z")
+
+
+def default_socket_path(port=PORT):
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, "slb-{}-{}.sock".format(os.getuid(), port))
+
+
+def make_request_header(size):
+    return struct.pack(REQUEST_HEADER_FMT, size)
+
+
+def make_response_header(size):
+    return struct.pack(RESPONSE_HEADER_FMT, size)
+
+
+def make_frame(kind, request_id, options, body):
+    options_bytes = bytes(json.dumps(options), "utf-8") if options else b""
+    header = struct.pack(FRAME_HEADER_FMT, FRAME_VERSION, kind, request_id,
+                         len(options_bytes), len(body))
+    return b"".join([FRAME_MAGIC, header, options_bytes, body])
+
+
+def connect(host="localhost", port=PORT, socket_path=None):
+    # The Unix socket is preferred, TCP is used when the daemon doesn't
+    # listen on one.
+    if socket_path and hasattr(socket, "AF_UNIX"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            return sock
+        except OSError:
+            sock.close()
+    return socket.create_connection((host, port))
+
+
+def shm_path(name):
+    if not SHM_NAME_RE.match(name):
+        raise ValueError("bad shm name {!r}".format(name))
+    return os.path.join(SHM_DIR, name)
+
+
+def write_shm(data):
+    fd, path = tempfile.mkstemp(prefix="slb-", dir=SHM_DIR)
+    with os.fdopen(fd, mode="wb") as shmFile:
+        shmFile.write(data)
+    return os.path.basename(path)
+
+
+def take_shm(name) -> MappedTextSource:
+    # The mapping stays readable after the file is removed.
+    path = shm_path(name)
+    source = MappedTextSource.from_path(path)
+    os.unlink(path)
+    return source
+
+
+def read_frame(sock):
+    header = _read_bytes(sock, len(FRAME_MAGIC) + FRAME_HEADER_SIZE)
+    if bytes(header[:len(FRAME_MAGIC)]) != FRAME_MAGIC:
+        raise ValueError("bad frame magic")
+    version, kind, request_id, options_size, body_size = \
+        struct.unpack(FRAME_HEADER_FMT, header[len(FRAME_MAGIC):])
+    options = _read_bytes(sock, options_size)
+    options = json.loads(options) if options else dict()
+    body = _read_bytes(sock, body_size)
+    if "shm" in options:
+        with take_shm(options["shm"]) as source:
+            body = source.buffer[:]
+    return {"kind": kind,
+            "request_id": request_id,
+            "options": options,
+            "body": str(body, "utf-8")}
+
+
+def read_response_header(sock):
+    header = struct.unpack(RESPONSE_HEADER_FMT,
+                           sock.recv(struct.calcsize(RESPONSE_HEADER_FMT)))
+    return {"size": header[0]}
+
+
+def read_response(sock):
+    header = read_response_header(sock)
+    return (header, _read_utf8(sock, header["size"]))
+
+
+def _read_bytes(sock, size):
+    bytes_read = 0
+    read = bytearray(b'\0' * size)
+    while bytes_read < size:
+        f = bytes_read
+        t = min(bytes_read + 4096, size)
+        received = sock.recv_into(memoryview(read)[f: t])
+        if received == 0:
+            raise ConnectionError("connection closed")
+        bytes_read += received
+    return read
+
+
+def _read_utf8(sock, size):
+    return str(_read_bytes(sock, size), "utf-8")
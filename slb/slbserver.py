@@ -1,91 +1,468 @@
-
-import socketserver
-import process
-import nlp
+import asyncio
+import collections
+import concurrent.futures
+import gc
+import instrument
+import json
+import os
+import signal
+import socket
+import stat
 import struct
+import sys
+import time
+import traceback
 import md
+import nlp
+import tex
+
+from incremental import IncrementalDoc
+from process import Doc
+from protocol import (PORT, REQUEST_HEADER_FMT, RESPONSE_HEADER_FMT, REQUEST_HEADER_SIZE,
+                      FRAME_MAGIC, FRAME_VERSION, FRAME_HEADER_FMT, FRAME_HEADER_SIZE,
+                      KIND_FORMAT, KIND_RESPONSE, KIND_ERROR, KIND_OPEN, KIND_EDIT,
+                      KIND_CLOSE, KIND_STATS, SHM_MIN_BYTES, make_response_header,
+                      make_frame, write_shm, take_shm)
+from util import MappedTextSource
 
-PORT = 29010
-REQUEST_HEADER_FMT = "L"
-RESPONSE_HEADER_FMT = "L"
+FRAME_KIND_NAMES = {KIND_FORMAT: "format",
+                    KIND_OPEN: "open",
+                    KIND_EDIT: "edit",
+                    KIND_CLOSE: "close",
+                    KIND_STATS: "stats"}
+
+DOC_FORMATS = {"md": md.MdDoc,
+               "tex": tex.TexDoc}
 
 
 class SlbDaemon():
+    def __init__(self, host="localhost", port=PORT, workers=4, max_pending=64,
+                 max_request_bytes=64 * 1024 * 1024, idle_timeout=300.0,
+                 max_batch=32, max_documents=256, warm_up=False, processes=1,
+                 drain_timeout=30.0, socket_path=None, exit_after_idle=None,
+                 format_kwargs=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_request_bytes = max_request_bytes
+        self.idle_timeout = idle_timeout
+        self.max_batch = max_batch
+        self.max_documents = max_documents
+        self.warm_up = warm_up
+        self.processes = processes
+        self.drain_timeout = drain_timeout
+        self.socket_path = socket_path
+        self.exit_after_idle = exit_after_idle
+        self.format_kwargs = format_kwargs or dict()
+        self.documents = collections.OrderedDict()
+        self.next_doc_id = 1
+
     def run(self):
-        with socketserver.TCPServer(("localhost", PORT), SlbRequestHandler) as server:
-            server.serve_forever()
+        # Instrumentation is cheap next to formatting, so the daemon always
+        # collects it for stats requests.
+        instrument.enable()
+        self.started = time.time()
+        listeners = [socket.create_server((self.host, self.port), backlog=128)]
+        if self.socket_path:
+            listeners.append(self._bind_unix(self.socket_path))
+        try:
+            if self.processes > 1:
+                self.run_prefork(listeners)
+                return
+            # Models otherwise load lazily on the first request that needs them.
+            if self.warm_up:
+                self.format_kwargs.get("tokenizer", nlp.Tokenizer).warm_up()
+            asyncio.run(self.serve(listeners))
+        finally:
+            for listener in listeners:
+                listener.close()
+            if self.socket_path:
+                os.unlink(self.socket_path)
+
+    @staticmethod
+    def _bind_unix(path):
+        # A socket file left by a daemon that died is replaced, anything else
+        # at the path is an error.
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(128)
+        return listener
 
+    def run_prefork(self, listeners):
+        # The parent loads the model and forks worker processes that share
+        # it copy-on-write and accept on the same listening sockets. Each
+        # worker serves its own connections, so documents opened on a
+        # connection live in the worker that accepted it. SIGHUP reloads the
+        # model and replaces the workers, which finish their requests first.
+        tokenizer = self.format_kwargs.get("tokenizer", nlp.Tokenizer)
+        tokenizer.warm_up()
+        signals = []
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+        generation = 0
+        children = dict()
+        gc.freeze()
+        for _ in range(self.processes):
+            children[self._fork_worker(listeners)] = (generation, time.monotonic())
+        while children:
+            while signals:
+                signum = signals.pop(0)
+                if signum == signal.SIGHUP and generation >= 0:
+                    tokenizer.unload()
+                    tokenizer.warm_up()
+                    gc.freeze()
+                    old = list(children)
+                    generation += 1
+                    for _ in range(self.processes):
+                        children[self._fork_worker(listeners)] = (generation, time.monotonic())
+                    self._signal_children(old, signal.SIGTERM)
+                elif signum != signal.SIGHUP:
+                    # No more restarts once stopping.
+                    generation = -1
+                    self._signal_children(children, signal.SIGTERM)
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            child_generation, forked = children.pop(pid, (None, None))
+            if child_generation is not None and child_generation == generation:
+                print("slb worker {} exited with status {}, restarting"
+                      .format(pid, status), file=sys.stderr)
+                # Don't spin on a worker that dies right away.
+                time.sleep(max(0.0, 1.0 - (time.monotonic() - forked)))
+                children[self._fork_worker(listeners)] = (generation, time.monotonic())
+
+    def _fork_worker(self, listeners):
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            asyncio.run(self.serve(listeners))
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
 
-class SlbRequestHandler(socketserver.BaseRequestHandler):
     @staticmethod
-    def _make_response_header(size):
-        return struct.pack(RESPONSE_HEADER_FMT, size)
-
-    def handle(self):
-        self.request.settimeout(1)
-        data = SocketSource(self.request)
-        doc = md.MdDoc.from_source(data)
-        response_bytes = bytes("\n".join(doc.format_out()), "utf-8")
-        header = self._make_response_header(len(response_bytes))
-        self.request.sendall(header)
-        self.request.sendall(response_bytes)
-
-
-def make_request_header(size):
-    return struct.pack(REQUEST_HEADER_FMT, size)
-
-
-def read_response_header(sock):
-    header = struct.unpack(RESPONSE_HEADER_FMT,
-                           sock.recv(struct.calcsize(RESPONSE_HEADER_FMT))) 
-    return {"size": header[0]}
-
-
-def read_response(sock):
-    header = read_response_header(sock)
-    return (header, _read_utf8(sock, header["size"]))
-
-
-def _read_utf8(sock, size):
-    bytes_read = 0
-    read = bytearray(b'\0' * size)
-    while bytes_read < size:
-        f = bytes_read
-        t = min(bytes_read + 4096, size)
-        bytes_read += sock.recv_into(memoryview(read)[f: t])
-    return str(read, "utf-8")
-
-
-class SocketSource(process.TextSource):
-    def __init__(self, sock):
-        self.sock = sock
-        self.chars_returned = 0
-        self.head = None
-        self._read()
-
-    def _read(self):
-        header = struct.unpack(REQUEST_HEADER_FMT,
-                               self.sock.recv(struct.calcsize(REQUEST_HEADER_FMT)))
-        bytesize = header[0]
-        self.buffer = _read_utf8(self.sock, bytesize)
-
-    def __next__(self):
-        if self.head is not None:
-            temp = self.head
-            self.head = None
-            return temp
-
-        if self.chars_returned >= len(self.buffer):
-            raise StopIteration()
-
-        idx = self.buffer.find("\n", self.chars_returned)
-        idx = idx + 1 if idx != -1 else len(self.buffer)
-        to_return = self.buffer[self.chars_returned: idx]
-        self.chars_returned = idx
-        print("\"" + to_return.rstrip() + "\"")
-        return to_return.rstrip()
-
-    def peek(self):
-        if self.head is None:
-            self.head = next(self)
-        return self.head
+    def _signal_children(pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    async def serve(self, listeners):
+        # Requests wait for a slot before their body is read, so a full queue
+        # stops reading from sockets and pushes back on clients over TCP.
+        self.pending = asyncio.Semaphore(self.max_pending)
+        self.running = asyncio.Semaphore(self.workers)
+        self.queue = asyncio.Queue()
+        self.connections = 0
+        self.last_active = time.monotonic()
+        stopping = asyncio.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self.executor = executor
+            batcher = asyncio.create_task(self.batch_documents())
+            # Pre-forked workers would only be restarted, so only a single
+            # process daemon exits once idle.
+            watchdog = None
+            if self.exit_after_idle is not None and self.processes <= 1:
+                watchdog = asyncio.create_task(self._exit_when_idle(stopping))
+            servers = []
+            for listener in listeners:
+                if listener.family == getattr(socket, "AF_UNIX", None):
+                    server = await asyncio.start_unix_server(self.handle_connection,
+                                                             sock=listener)
+                else:
+                    server = await asyncio.start_server(self.handle_connection, sock=listener)
+                servers.append(server)
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+            except NotImplementedError:
+                pass
+            try:
+                await stopping.wait()
+                # Stop accepting, then let the requests already read finish.
+                for server in servers:
+                    server.close()
+                try:
+                    await asyncio.wait_for(self._drain(), self.drain_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                for server in servers:
+                    server.close()
+                batcher.cancel()
+                if watchdog is not None:
+                    watchdog.cancel()
+
+    async def _exit_when_idle(self, stopping):
+        # Idle is no open connections for exit_after_idle seconds.
+        while True:
+            idle = time.monotonic() - self.last_active
+            if self.connections == 0 and idle >= self.exit_after_idle:
+                stopping.set()
+                return
+            await asyncio.sleep(max(self.exit_after_idle - idle, 0.1))
+
+    async def _drain(self):
+        for _ in range(self.max_pending):
+            await self.pending.acquire()
+
+    async def handle_connection(self, reader, writer):
+        tasks = set()
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    prefix = await asyncio.wait_for(
+                        reader.readexactly(REQUEST_HEADER_SIZE), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                await self.pending.acquire()
+                # Only the rest of the request is timed, not the wait for it.
+                started = instrument.start()
+                try:
+                    if FRAME_MAGIC.startswith(prefix):
+                        frame = await asyncio.wait_for(
+                            self._read_frame(reader, prefix), self.idle_timeout)
+                    else:
+                        size = struct.unpack(REQUEST_HEADER_FMT, prefix)[0]
+                        if size > self.max_request_bytes:
+                            raise ConnectionError("request too large")
+                        body = await asyncio.wait_for(reader.readexactly(size),
+                                                      self.idle_timeout)
+                        instrument.count("bytes_in", REQUEST_HEADER_SIZE + size)
+                        instrument.count("requests.legacy")
+                        frame = None
+                    instrument.stop("socket_read", started)
+                except BaseException:
+                    self.pending.release()
+                    raise
+
+                if frame is None:
+                    try:
+                        response_bytes = await self.submit(body, md.MdDoc, self.format_kwargs)
+                    finally:
+                        self.pending.release()
+                    writer.write(make_response_header(len(response_bytes)))
+                    writer.write(response_bytes)
+                    instrument.count("bytes_out", struct.calcsize(RESPONSE_HEADER_FMT)
+                                     + len(response_bytes))
+                    await writer.drain()
+                else:
+                    # Framed requests are answered as soon as they are done,
+                    # possibly out of order, while the connection keeps reading.
+                    task = asyncio.create_task(self.handle_frame(frame, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    task.add_done_callback(lambda t: self.pending.release())
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            self.connections -= 1
+            self.last_active = time.monotonic()
+
+    async def _read_frame(self, reader, prefix):
+        magic = prefix + await reader.readexactly(len(FRAME_MAGIC) - len(prefix))
+        if magic != FRAME_MAGIC:
+            raise ConnectionError("bad frame magic")
+        header = await reader.readexactly(FRAME_HEADER_SIZE)
+        version, kind, request_id, options_size, body_size = \
+            struct.unpack(FRAME_HEADER_FMT, header)
+        if version != FRAME_VERSION or options_size + body_size > self.max_request_bytes:
+            raise ConnectionError("unsupported frame")
+        options = await reader.readexactly(options_size)
+        body = await reader.readexactly(body_size)
+        instrument.count("bytes_in", len(FRAME_MAGIC) + FRAME_HEADER_SIZE
+                         + options_size + body_size)
+        return kind, request_id, options, body
+
+    async def handle_frame(self, frame, writer):
+        kind, request_id, options, body = frame
+        response_options = None
+        try:
+            options = json.loads(options or b"{}")
+            response_kind = KIND_RESPONSE
+            if kind == KIND_FORMAT:
+                if "shm" in options:
+                    # Anyone can name a file in SHM_DIR, only a client on the
+                    # Unix socket, which is private to the user, may have it
+                    # read. It is taken first, so that it is removed even when
+                    # the other options are bad.
+                    if writer.get_extra_info("socket").family != getattr(socket, "AF_UNIX",
+                                                                         None):
+                        raise ValueError("shm is only accepted over the Unix socket")
+                    body = take_shm(options["shm"])
+                    instrument.count("shm_bytes_in", len(body.buffer))
+                try:
+                    doc_class, kwargs = self.get_request_config(options)
+                except Exception:
+                    if isinstance(body, MappedTextSource):
+                        body.close()
+                    raise
+                response_bytes = await self.submit(body, doc_class, kwargs)
+                if "shm" in options and len(response_bytes) >= SHM_MIN_BYTES:
+                    response_options = {"shm": write_shm(response_bytes)}
+                    instrument.count("shm_bytes_out", len(response_bytes))
+                    response_bytes = b""
+            elif kind in (KIND_OPEN, KIND_EDIT, KIND_CLOSE):
+                response_options, response_bytes = \
+                    await self.handle_document(kind, options, body)
+            elif kind == KIND_STATS:
+                response_bytes = bytes(json.dumps(self.get_stats()), "utf-8")
+            else:
+                raise ValueError("unknown request kind {}".format(kind))
+        except Exception as e:
+            response_kind = KIND_ERROR
+            response_bytes = bytes("{}: {}".format(type(e).__name__, e), "utf-8")
+        frame = make_frame(response_kind, request_id, response_options, response_bytes)
+        instrument.count("requests.{}".format(FRAME_KIND_NAMES.get(kind, "unknown")))
+        instrument.count("bytes_out", len(frame))
+        writer.write(frame)
+        await writer.drain()
+
+    async def handle_document(self, kind, options, body):
+        if kind == KIND_OPEN:
+            doc_class, kwargs = self.get_request_config(options)
+            doc = await self.run_in_worker(IncrementalDoc.from_text, doc_class,
+                                           str(body, "utf-8"), **kwargs)
+            doc_id = self.next_doc_id
+            self.next_doc_id += 1
+            self.documents[doc_id] = (doc, asyncio.Lock())
+            while len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+            return {"doc_id": doc_id}, bytes("\n".join(doc.output_lines()), "utf-8")
+
+        doc_id = options["doc_id"]
+        if doc_id not in self.documents:
+            raise KeyError("unknown doc_id {}".format(doc_id))
+        if kind == KIND_CLOSE:
+            del self.documents[doc_id]
+            return None, b""
+        self.documents.move_to_end(doc_id)
+        doc, lock = self.documents[doc_id]
+        async with lock:
+            patch = await self.run_in_worker(doc.apply_edit, options["start"],
+                                             options["end"], str(body, "utf-8"))
+        return None, bytes(json.dumps(patch.to_dict()), "utf-8")
+
+    async def run_in_worker(self, function, *args, **kwargs):
+        async with self.running:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: function(*args, **kwargs))
+
+    def get_stats(self):
+        stats = instrument.STATS.snapshot()
+        stats["pid"] = os.getpid()
+        stats["uptime"] = time.time() - self.started
+        stats["open_documents"] = len(self.documents)
+        return stats
+
+    def get_request_config(self, options):
+        kwargs = self.format_kwargs.copy()
+        doc_class = DOC_FORMATS[options.get("format", "md")]
+        if "fill_width" in options:
+            kwargs["fill_width"] = int(options["fill_width"])
+        if "nlp" in options:
+            kwargs["tokenizer"], kwargs["allocator"] = nlp.NLP_BACKENDS[options["nlp"]]
+        if "allocator" in options:
+            # Line breakers are keyed by the tier's base allocator, the daemon's
+            # own allocator may already be a numpy or optimal one.
+            tokenizer = kwargs.get("tokenizer", nlp.Tokenizer)
+            base = next(allocator for tier_tokenizer, allocator in nlp.NLP_BACKENDS.values()
+                        if tier_tokenizer is tokenizer)
+            kwargs["allocator"] = nlp.LINE_BREAKERS[options["allocator"]][base]
+        return doc_class, kwargs
+
+    def submit(self, body, doc_class, kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((body, doc_class, kwargs, future))
+        return future
+
+    async def batch_documents(self):
+        # Everything queued while the workers are busy is formatted together,
+        # so paragraphs of concurrent requests share tokenizer batches. A
+        # worker is only taken once there is work for it, document requests
+        # wait for the same workers in run_in_worker.
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            await self.running.acquire()
+            while len(items) < self.max_batch and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            instrument.count("batches")
+            work = loop.run_in_executor(self.executor, self.format_batch,
+                                        [item[:3] for item in items])
+            work.add_done_callback(lambda f, items=items: self._finish_batch(f, items))
+
+    def _finish_batch(self, work, items):
+        self.running.release()
+        if work.exception() is not None:
+            results = [work.exception()] * len(items)
+        else:
+            results = work.result()
+        for item, result in zip(items, results):
+            future = item[3]
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    @instrument.timed("format_batch")
+    def format_batch(items):
+        results = [None] * len(items)
+        groups = dict()
+        for i, (body, doc_class, kwargs) in enumerate(items):
+            try:
+                if not isinstance(body, MappedTextSource):
+                    body = MappedTextSource(body)
+                doc = doc_class.from_source(body)
+                kwargs = doc.get_format_config(**kwargs)
+            except Exception as e:
+                results[i] = e
+                continue
+            tokenizer = kwargs.get("tokenizer", nlp.Tokenizer)
+            groups.setdefault(tokenizer, []).append((i, doc, kwargs))
+
+        for group in groups.values():
+            try:
+                Doc.parse_docs([(doc, kwargs) for i, doc, kwargs in group])
+            except Exception as e:
+                for i, doc, kwargs in group:
+                    results[i] = e
+                continue
+            for i, doc, kwargs in group:
+                try:
+                    results[i] = bytes("\n".join(doc.format_out(**kwargs)), "utf-8")
+                except Exception as e:
+                    results[i] = e
+        for body, doc_class, kwargs in items:
+            if isinstance(body, MappedTextSource):
+                body.close()
+        return results
+
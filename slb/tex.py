@@ -15,11 +15,7 @@ class TexParagraphRegion(ParagraphRegion):
     def __init__(self, lines: Iterable[str]):
         super().__init__(lines)
 
-    @staticmethod
-    def _is_term_line_exclusive(line, state):
-        return any(region_type.is_init_line(line, state)
-                   for region_type in TexDoc.get_region_types()
-                   if region_type != TexParagraphRegion)
+    TERM_ON_OTHER_INIT = True
 
 
 class ItemizeRegion(BulletRegion):
@@ -28,14 +24,8 @@ class ItemizeRegion(BulletRegion):
 
     START_RE = re.compile(r"\\begin{(enumerate|itemize)}")
     END_RE = re.compile(r"\\end{(enumerate|itemize)}")
-
-    @staticmethod
-    def _is_init_line_inclusive(line, state):
-        return ItemizeRegion.START_RE.match(line) is not None
-
-    @staticmethod
-    def _is_term_line_inclusive(line, state):
-        return ItemizeRegion.END_RE.match(line) is not None
+    INIT_RE = START_RE
+    TERM_INCLUSIVE_RE = END_RE
 
     @classmethod
     def get_prefix(cls, src: TextSource) -> List[str]:
@@ -1,5 +1,13 @@
-from typing import Callable
+import array
+import bisect
+import collections.abc
+import itertools
+import mmap
+import operator
+import os
+import re
 
+from typing import Iterable, List
 
 class TextSource:
     def __iter__(self):
@@ -37,21 +45,166 @@ class FileTextSource(TextSource):
         return self.head
 
 
-class RegionSource(TextSource):
-    def __init__(self, source: TextSource, stop_predicate: Callable[[str], bool]):
-        self.source = source
-        self.stop_predicate = stop_predicate
+class MappedTextSource(TextSource):
+    # Lines of a UTF-8 buffer such as an mmap of a file or a request body.
+    # Only line offsets are kept, lines are decoded a block at a time as they
+    # are read. A "\r\n" line keeps its "\r" until it is stripped.
+    NEWLINE_RE = re.compile(rb"\r(?!\n)|\n")
+    LINE_SPLIT_RE = re.compile(r"\r(?!\n)|\n")
+    BLOCK_LINES = 4096
+    CHUNK_BYTES = 1 << 20
 
-    def __next__(self):
-        head = self.source.peek()
-        if (self.stop_predicate(head)):
-            raise StopIteration()
+    def __init__(self, buffer, mapping: mmap.mmap = None):
+        self.buffer = buffer
+        self.mapping = mapping
+        # Line i is buffer[starts[i]: starts[i + 1] - 1], the last start is
+        # one past the end when the buffer doesn't end with a newline.
+        self.lone_cr = re.search(rb"\r(?!\n)", buffer) is not None
+        if self.lone_cr:
+            self.starts = array.array("Q", itertools.chain(
+                [0], map(re.Match.end, self.NEWLINE_RE.finditer(buffer))))
         else:
-            return next(self.source)
+            self.starts = self._newline_starts(buffer)
+        if self.starts[-1] < len(buffer):
+            self.starts.append(len(buffer) + 1)
+        self.index = 0
+        self.block = []
+        self.block_start = 0
+        # The empty lines among those read so far, so that spans split into
+        # paragraphs without decoding their lines again.
+        self.empty = array.array("Q")
+        self.read_until = 0
+
+    @classmethod
+    def _newline_starts(cls, buffer) -> array.array:
+        # Starts of the lines after each "\n", from the lengths of the lines
+        # of a chunk at a time, which is faster than a match per line.
+        starts = array.array("Q", [0])
+        pos = 0
+        while pos < len(buffer):
+            end = buffer.find(b"\n", min(pos + cls.CHUNK_BYTES, len(buffer)) - 1)
+            end = len(buffer) if end < 0 else end + 1
+            lines = buffer[pos:end].split(b"\n")
+            lines.pop()
+            starts.extend(map(operator.add, itertools.accumulate(map(len, lines)),
+                              itertools.count(pos + 1)))
+            pos = end
+        return starts
+
+    @classmethod
+    def from_path(cls, path: str) -> "MappedTextSource":
+        with open(path, mode="rb") as inputFile:
+            if os.fstat(inputFile.fileno()).st_size == 0:
+                return cls(b"")
+            try:
+                mapping = mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Pipes and other unmappable files are read instead.
+                return cls(inputFile.read())
+        return cls(mapping, mapping)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def line(self, i: int) -> str:
+        return str(self.buffer[self.starts[i]: self.starts[i + 1] - 1], "utf-8").rstrip()
+
+    def lines(self, start: int, end: int) -> List[str]:
+        if start >= end:
+            return []
+        # The text ends with the newline of the last line, if it has one.
+        count = end - start
+        text = str(self.buffer[self.starts[start]: self.starts[end]], "utf-8")
+        if self.lone_cr:
+            return [l.rstrip() for l in self.LINE_SPLIT_RE.split(text, count)[:count]]
+        return [l.rstrip() for l in text.split("\n", count)[:count]]
+
+    def text(self, start: int, end: int) -> str:
+        # Lines start to end as they are in the buffer, with line endings.
+        return str(self.buffer[self.starts[start]: self.starts[end]], "utf-8")
+
+    def spans(self, start: int, end: int) -> "LineSpans":
+        return LineSpans(self, start, end)
+
+    def __next__(self):
+        line = self.peek()
+        self.index += 1
+        return line
 
     def peek(self):
-        head = self.source.peek()
-        if (self.stop_predicate(head)):
-            raise StopIteration()
-        else:
-            return head
+        i = self.index - self.block_start
+        if i >= len(self.block):
+            if self.index >= len(self):
+                raise StopIteration()
+            self._read_block()
+            i = 0
+        return self.block[i]
+
+    def blocks(self) -> Iterable[List[str]]:
+        # The remaining lines a block at a time, for readers of every line.
+        # A block's lines count as read once it is yielded.
+        rest = self.block[self.index - self.block_start:]
+        self.index += len(rest)
+        if rest:
+            yield rest
+        while self.index < len(self):
+            self._read_block()
+            self.index += len(self.block)
+            yield self.block
+
+    def _read_block(self):
+        start = self.index
+        end = min(start + self.BLOCK_LINES, len(self))
+        self.block = self.lines(start, end)
+        self.block_start = start
+        if end > self.read_until:
+            first = max(start, self.read_until)
+            self.empty.extend(itertools.compress(
+                range(first, end), map(operator.not_, self.block[first - start:])))
+            self.read_until = end
+
+
+class LineSpans(collections.abc.Sequence):
+    # Lines start to end of a MappedTextSource, decoded on access.
+    def __init__(self, source: MappedTextSource, start: int, end: int):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, end, step)]
+            return LineSpans(self.source, self.start + start, self.start + max(start, end))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+        return self.source.line(self.start + i)
+
+    def __iter__(self):
+        return iter(self.source.lines(self.start, self.end))
+
+    def empty_lines(self) -> List[int]:
+        # Indices of the empty lines, without decoding once they were read.
+        if self.end > self.source.read_until:
+            return [i for i, line in enumerate(self) if not line]
+        empty = self.source.empty
+        first = bisect.bisect_left(empty, self.start)
+        last = bisect.bisect_left(empty, self.end, first)
+        return [i - self.start for i in empty[first:last]]